@@ -1,3 +1,5 @@
 from .cfgparser import BrainfuckParser
 from .lexer import BFLexer
 from .semantic_analysis import SemanticAnalysis
+from .program import compile, Program, CompileError
+from .instrumentation import Instrumentation
@@ -0,0 +1,295 @@
+# headless command line interface, runs the whole pipeline without the gui
+# usage: python -m compiler program.bf < input
+
+import argparse
+import os
+import sys
+
+from .lexer import BFLexer
+from .cfgparser import BrainFuckNode
+from .flatprogram import FlatProgram
+from .optimizer import ASTOptimizer, CELL_BIT_SIZE, INDEX_BIT_SIZE
+from .code_generation import (IRManager, EOF_BEHAVIORS, CELL_BIT_SIZES,
+                              OUTLINE_SIZE)
+from .interpreter import Interpreter, DEFAULT_JIT_THRESHOLD
+from .partial_eval import DEFAULT_STEP_BUDGET
+from .program import check_program
+from .perfmap import perf_map_path
+from .instrumentation import (Instrumentation, DISABLED, count_nodes,
+                              count_module)
+
+STAGES = ("tokens", "ast", "ir", "opt-ir", "asm")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m compiler", description="BrainF*ck compiler")
+    parser.add_argument(
+        "file", nargs="?", default="-",
+        help="source file to compile, or - to read the source from stdin")
+    parser.add_argument(
+        "-O", dest="opt_level", type=int, choices=(0, 1, 2, 3), default=2,
+        help="llvm optimization level (default 2)")
+    parser.add_argument(
+        "--no-ast-optimize", action="store_true",
+        help="skip the ast optimization passes")
+    parser.add_argument(
+        "--engine", choices=("jit", "interpret", "tiered"), default="jit",
+        help="compile the whole program (default), only interpret it, or "
+             "interpret it and compile the loops that get hot")
+    parser.add_argument(
+        "--jit-threshold", type=int, default=DEFAULT_JIT_THRESHOLD,
+        help="iterations before a loop is compiled with --engine tiered "
+             "(default {})".format(DEFAULT_JIT_THRESHOLD))
+    parser.add_argument(
+        "--eval-steps", type=int, default=DEFAULT_STEP_BUDGET,
+        help="ops to run at compile time before the first input, 0 turns "
+             "it off (default {})".format(DEFAULT_STEP_BUDGET))
+    parser.add_argument(
+        "--unbuffered", action="store_true",
+        help="write and read every byte straight away, for interactive use")
+    parser.add_argument(
+        "--eof", choices=EOF_BEHAVIORS, default="zero",
+        help="what , stores once the input runs out (default zero)")
+    parser.add_argument(
+        "--cell-bits", type=int, choices=CELL_BIT_SIZES, default=CELL_BIT_SIZE,
+        help="width of the tape cells (default {})".format(CELL_BIT_SIZE))
+    parser.add_argument(
+        "--tape-bits", type=int, default=INDEX_BIT_SIZE,
+        help="the tape has 2 ** TAPE_BITS cells (default {})".format(
+            INDEX_BIT_SIZE))
+    parser.add_argument(
+        "--guard-pages", action="store_true",
+        help="fault when the pointer runs off the tape instead of wrapping")
+    parser.add_argument(
+        "--outline-size", type=int, default=OUTLINE_SIZE,
+        help="ops after which a loop or a run of code is compiled as a "
+             "function of its own, to bound the llvm time of huge programs, "
+             "0 turns it off (default {})".format(OUTLINE_SIZE))
+    parser.add_argument(
+        "-o", dest="output",
+        help="compile ahead of time instead of running, the file extension "
+             "picks the output: .ll, .s, .o or an executable otherwise")
+    parser.add_argument(
+        "--cache", action="store_true",
+        help="reuse compiled code from the on-disk cache")
+    parser.add_argument(
+        "--cache-dir", help="cache directory (default ~/.cache/bfcompiler)")
+    parser.add_argument(
+        "--dump", action="append", choices=STAGES, default=[],
+        help="print an intermediate stage to stderr, can be repeated")
+    parser.add_argument(
+        "--profile", metavar="FILE",
+        help="count how often every loop, . and , runs and write the counts "
+             "to FILE when the program ends, a report of the hottest loops "
+             "follows on stderr when the program is run straight away")
+    parser.add_argument(
+        "--perf-map", action="store_true",
+        help="compile every loop into a function of its own and list them in "
+             "/tmp/perf-<pid>.map, so perf can tell where the time goes")
+    parser.add_argument(
+        "-g", dest="debug_info", action="store_true",
+        help="compile every loop into a function of its own, with line tables "
+             "pointing back into the source file")
+    parser.add_argument(
+        "--metrics", metavar="FILE",
+        help="write the time of every stage and the size of what it produced "
+             "to FILE as json, or to stderr with -")
+    args = parser.parse_args(argv)
+
+    # the interpreter only has the default tape
+    tape = (args.cell_bits, args.tape_bits, args.guard_pages)
+    if args.engine != "jit" and tape != (CELL_BIT_SIZE, INDEX_BIT_SIZE, False):
+        parser.error("--cell-bits, --tape-bits and --guard-pages need --engine jit")
+    if args.engine != "jit" and args.profile is not None:
+        parser.error("--profile needs --engine jit")
+    if args.engine != "jit" and (args.perf_map or args.debug_info):
+        parser.error("--perf-map and -g need --engine jit")
+    if args.debug_info and args.file == "-":
+        parser.error("-g needs a source file")
+    if args.tape_bits < 1:
+        parser.error("--tape-bits must be at least 1")
+    return args
+
+
+def lex_source(path, instrumentation=DISABLED):
+    lexer = BFLexer()
+    with instrumentation.stage("lex"):
+        if path == "-":
+            tokens = b"".join(lexer.lex_chunks(sys.stdin.buffer))
+        else:
+            tokens = lexer.lex_file(path)
+    instrumentation.count("tokens", len(tokens))
+    return tokens
+
+
+def print_tree(node):
+    stack = [(node, 0)]
+    while stack:
+        node, level = stack.pop()
+        print("  " * level + str(node), file=sys.stderr)
+        stack.extend((child, level + 1) for child in reversed(node.children))
+
+
+def build_program(tokens, args):
+    # analyze, parse and optimize the tokens,
+    # the flat program is much smaller than a tree of the raw tokens, a tree
+    # of the folded program is only built for the ast optimizer
+    ast, issues = check_program(
+        tokens, args.tape_bits, args.cell_bits, args.instrumentation)
+    for issue in issues:
+        print("[{}] {} at index {}".format(
+            issue.type, issue.value, issue.node.char_index), file=sys.stderr)
+    if any(issue.type == "error" for issue in issues):
+        sys.exit(1)
+
+    if not args.no_ast_optimize:
+        with args.instrumentation.stage("optimize"):
+            optimizer = ASTOptimizer(ast.to_tree(), args.cell_bits)
+            ast = optimizer.optimize()
+        if args.instrumentation.enabled:
+            args.instrumentation.count("optimized_nodes", count_nodes(ast))
+        if "ast" in args.dump:
+            print("{} dead nodes removed".format(optimizer.removed),
+                  file=sys.stderr)
+    if "ast" in args.dump:
+        print_tree(ast if isinstance(ast, BrainFuckNode) else ast.to_tree())
+    return ast
+
+
+def build_ir(tokens, args, split=False):
+    # the llvm ir for the tokens, split into a list of modules that can be
+    # compiled in parallel if split is set
+    ast = build_program(tokens, args)
+    with args.instrumentation.stage("codegen"):
+        manager = IRManager(
+            ast, buffered_io=not args.unbuffered, eof_behavior=args.eof,
+            cell_bits=args.cell_bits, tape_bits=args.tape_bits,
+            guard_pages=args.guard_pages, step_budget=args.eval_steps,
+            profile=args.profile,
+            outline_loops=args.perf_map or args.debug_info,
+            outline_size=args.outline_size or None,
+            debug_source=args.file if args.debug_info else None)
+        modules = manager.to_llvm_modules() if split else [
+            manager.to_llvm_ir()]
+    count_module(args.instrumentation, modules)
+    if "ir" in args.dump:
+        for ir_module in modules:
+            print(ir_module, file=sys.stderr)
+    return modules if split else modules[0]
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.instrumentation = DISABLED
+    if args.metrics is not None:
+        args.instrumentation = Instrumentation()
+    try:
+        return compile_and_run(args)
+    finally:
+        if args.metrics is not None:
+            write_metrics(args.instrumentation, args.metrics)
+
+
+def check_status(status):
+    # the native code only fails when it could not map the tape
+    if status != 0:
+        print("could not allocate the tape", file=sys.stderr)
+    return status
+
+
+def print_profile(tokens, args):
+    if args.profile is not None:
+        from .profile import read_profile, report
+        print(report(read_profile(args.profile), tokens), file=sys.stderr)
+
+
+def write_metrics(instrumentation, path):
+    if path == "-":
+        print(instrumentation.to_json(indent=2), file=sys.stderr)
+    else:
+        with open(path, "w") as f:
+            f.write(instrumentation.to_json(indent=2))
+
+
+def compile_and_run(args):
+    from .jit import JITCompiler, AOTCompiler
+
+    tokens = lex_source(args.file, args.instrumentation)
+    if "tokens" in args.dump:
+        print(tokens.decode("ascii"), file=sys.stderr)
+
+    if args.engine != "jit" and args.output is None:
+        ast = build_program(tokens, args)
+        if isinstance(ast, BrainFuckNode):
+            ast = FlatProgram.from_tree(ast)
+
+        threshold = args.jit_threshold if args.engine == "tiered" else None
+        interpreter = Interpreter(
+            ast, eof_behavior=args.eof, jit_threshold=threshold,
+            opt_level=args.opt_level, buffered_io=not args.unbuffered)
+        with args.instrumentation.stage("run"):
+            return interpreter.run()
+
+    if args.output is not None:
+        compiler = AOTCompiler(args.opt_level, args.instrumentation)
+    else:
+        cache = None
+        if args.cache:
+            from .cache import ObjectCache
+            cache = ObjectCache(args.cache_dir)
+        perf_map = perf_map_path() if args.perf_map else None
+        compiler = JITCompiler(args.opt_level, cache=cache, verbose=False,
+                               instrumentation=args.instrumentation,
+                               perf_map=perf_map)
+
+    if args.output is None and not {"opt-ir", "asm"} & set(args.dump):
+        if compiler.cache is not None:
+            key = compiler.cache_key(
+                tokens, ast_optimize=not args.no_ast_optimize,
+                unbuffered=args.unbuffered, eof=args.eof,
+                cell_bits=args.cell_bits, tape_bits=args.tape_bits,
+                guard_pages=args.guard_pages, eval_steps=args.eval_steps,
+                profile=args.profile,
+                outline_loops=args.perf_map or args.debug_info,
+                outline_size=args.outline_size,
+                debug_source=os.path.abspath(args.file) if args.debug_info
+                else None)
+            status = compiler.run_cached(key, lambda: build_ir(tokens, args))
+        else:
+            status = compiler.run_modules(build_ir(tokens, args, split=True))
+        print_profile(tokens, args)
+        return check_status(status)
+
+    extension = os.path.splitext(args.output or "")[1]
+    if args.output is not None and extension not in (".ll", ".s", ".o") \
+            and not {"opt-ir", "asm"} & set(args.dump):
+        compiler.build_executable(build_ir(tokens, args, split=True),
+                                  args.output)
+        return 0
+
+    ir_module = build_ir(tokens, args)
+    if "opt-ir" in args.dump:
+        print(compiler.dump_ir(ir_module), file=sys.stderr)
+    if "asm" in args.dump:
+        print(compiler.target_machine.emit_assembly(
+            compiler.optimize(ir_module)), file=sys.stderr)
+
+    if args.output is None:
+        status = compiler.run(ir_module)
+        print_profile(tokens, args)
+        return check_status(status)
+
+    if extension == ".ll":
+        compiler.emit_ir(ir_module, args.output)
+    elif extension == ".s":
+        compiler.emit_assembly(ir_module, args.output)
+    elif extension == ".o":
+        compiler.emit_object(ir_module, args.output)
+    else:
+        compiler.build_executable(ir_module, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,434 @@
+# benchmarks of every stage of the pipeline over a corpus of programs, the
+# results are written as json so runs on different commits can be compared
+# usage: python -m compiler.benchmark [-o results.json] [--compare old.json]
+
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import llvmlite
+
+from .lexer import BFLexer
+from .flatprogram import FlatProgram
+from .semantic_analysis import SemanticAnalysis
+from .range_analysis import PointerRangeAnalysis
+from .optimizer import ASTOptimizer
+from .code_generation import IRManager
+from .jit import JITCompiler
+from .program import Program
+
+
+STAGES = ("lex", "semantic", "parse", "range", "optimize", "codegen",
+          "llvm-opt", "jit", "run")
+
+CORPUS_DIRECTORY = os.path.join(os.path.dirname(__file__), "corpus")
+
+# a stage is only a regression if it got this much slower, and by more than
+# the noise floor in seconds
+DEFAULT_THRESHOLD = 0.1
+NOISE_FLOOR = 0.001
+
+
+class CodeWriter:
+    # writes brainfuck with cells at fixed positions, so the generated
+    # programs don't have to count > and < by hand
+    def __init__(self) -> None:
+        self.code = []
+        self.pointer = 0
+
+    def move(self, cell):
+        distance = cell - self.pointer
+        self.code.append(">" * distance if distance > 0 else "<" * -distance)
+        self.pointer = cell
+
+    def add(self, cell, amount):
+        self.move(cell)
+        self.code.append("+" * amount if amount > 0 else "-" * -amount)
+
+    def emit(self, cell, code):
+        # code that leaves the pointer where it found it
+        self.move(cell)
+        self.code.append(code)
+
+    def clear(self, cell):
+        self.emit(cell, "[-]")
+
+    def move_add(self, source, *targets):
+        # add source to every target, leaving source zero
+        with self.loop(source):
+            self.add(source, -1)
+            for target in targets:
+                self.add(target, 1)
+
+    def copy(self, source, target, temporary):
+        # add source to target, through a zero temporary cell
+        self.move_add(source, target, temporary)
+        self.move_add(temporary, source)
+
+    @contextmanager
+    def loop(self, cell):
+        self.emit(cell, "[")
+        yield
+        self.emit(cell, "]")
+
+    def getvalue(self):
+        return "".join(self.code)
+
+
+def hanoi(disks=20):
+    # the disk that moves at each step of the towers of hanoi, from a binary
+    # counter: each step clears the trailing ones and the disk of the first
+    # zero bit moves. each disk has three cells, its bit, its letter and a 1
+    # to scan back over. the counter running into the bit after the last
+    # disk prints a newline and stops the program
+    writer = CodeWriter()
+    for disk in range(1, disks + 2):
+        letter = ord("A") + disk - 1 if disk <= disks else ord("\n")
+        writer.add(3 * disk - 1, letter)
+        writer.add(3 * disk, 1)
+
+    overflow = 3 * disks + 1
+    running = overflow + 3
+    writer.add(running, 1)
+    with writer.loop(running):
+        writer.move(1)
+        writer.code.append("[->>>]+>.<<[<<<]")
+        # the scan back ends on the 0 before the first bit
+        writer.pointer = 0
+        with writer.loop(overflow):
+            writer.add(overflow, -1)
+            writer.add(running, -1)
+    return writer.getvalue()
+
+
+def mandelbrot_style(escape=4):
+    # an escape time fractal on 8 bit cells: every character of the grid is
+    # the number of steps of z = z * z + z + c, with c from its coordinates,
+    # until z is at most escape. the multiplies are loops around copy loops,
+    # so the work is done at runtime, and how much of it depends on the data.
+    # the width, height and step limit are read from the input, so neither
+    # the partial evaluator nor llvm can work out the picture ahead of time
+    (rows, columns, x, y, c, z, steps, count, times, square, temporary, escaped,
+     newline, width, iterations, probe) = range(16)
+
+    writer = CodeWriter()
+    writer.add(newline, 10)
+    writer.emit(width, ",")
+    writer.emit(rows, ",")
+    writer.emit(iterations, ",")
+    with writer.loop(rows):
+        writer.add(y, 1)
+        writer.clear(x)
+        writer.copy(width, columns, temporary)
+        with writer.loop(columns):
+            writer.add(x, 1)
+
+            # c = x * y + 1
+            writer.clear(c)
+            writer.copy(x, times, temporary)
+            with writer.loop(times):
+                writer.add(times, -1)
+                writer.copy(y, c, temporary)
+            writer.add(c, 1)
+
+            writer.clear(z)
+            writer.clear(steps)
+            writer.copy(iterations, count, temporary)
+            with writer.loop(count):
+                # z = z * z + z + c
+                writer.copy(z, times, temporary)
+                with writer.loop(times):
+                    writer.add(times, -1)
+                    writer.copy(z, square, temporary)
+                writer.copy(z, square, temporary)
+                writer.clear(z)
+                writer.move_add(square, z)
+                writer.copy(c, z, temporary)
+                writer.add(steps, 1)
+                writer.add(count, -1)
+
+                # stop once z is at most escape: take up to escape off a
+                # copy of it and see if anything is left
+                writer.add(escaped, 1)
+                writer.copy(z, times, temporary)
+                for _ in range(escape):
+                    writer.copy(times, probe, temporary)
+                    with writer.loop(probe):
+                        writer.clear(probe)
+                        writer.add(times, -1)
+                with writer.loop(times):
+                    writer.clear(times)
+                    writer.add(escaped, -1)
+                with writer.loop(escaped):
+                    writer.add(escaped, -1)
+                    writer.clear(count)
+
+            # one printable character per step count
+            writer.add(steps, ord(" "))
+            writer.emit(steps, ".")
+            writer.add(columns, -1)
+        writer.emit(newline, ".")
+        writer.add(rows, -1)
+    return writer.getvalue()
+
+
+def deep_nesting(depth=2000):
+    # loops nested far past python's recursion limit, each runs once. the
+    # input first keeps the partial evaluator from running the whole thing
+    return ",[-]+" + "[>+" * depth + "<-]" * depth
+
+
+def huge_source(size=8 * 2 ** 20, copies=50):
+    # a big file that is mostly comments around copies of hello world
+    with open(os.path.join(CORPUS_DIRECTORY, "hello.bf")) as f:
+        hello = f.read()
+    code = hello.splitlines()[-1]
+    comment = "a comment line in a very long file\n"
+    lines = max(size // copies - len(code), 0) // len(comment)
+    return (comment * lines + code + "\n") * copies
+
+
+GENERATED = {
+    "mandelbrot-style": mandelbrot_style,
+    "hanoi": hanoi,
+    "deep-nesting": deep_nesting,
+    "huge-source": huge_source,
+}
+
+# the input of the programs that read one, the rest run on no input
+INPUTS = {
+    # the biggest grid and step limit that fit in the cells
+    "mandelbrot-style": bytes((255, 255, 255)),
+}
+
+
+def load_corpus(names=None):
+    # the bundled programs and the generated ones by name
+    corpus = {}
+    for filename in sorted(os.listdir(CORPUS_DIRECTORY)):
+        name, extension = os.path.splitext(filename)
+        if extension == ".bf":
+            with open(os.path.join(CORPUS_DIRECTORY, filename)) as f:
+                corpus[name] = f.read()
+    for name, generate in GENERATED.items():
+        if names is None or name in names:
+            corpus[name] = generate()
+
+    if names is not None:
+        unknown = set(names) - set(corpus)
+        if unknown:
+            raise ValueError("no programs named {}".format(", ".join(sorted(unknown))))
+        corpus = {name: corpus[name] for name in names}
+    return corpus
+
+
+def run_stages(source, measure, opt_level=2, input=b""):
+    # the pipeline of compile() one stage at a time, measure(stage, function)
+    # calls function and returns what it returns. returns the output
+    tokens = measure("lex", lambda: BFLexer().lex_fast(source))
+
+    analysis = SemanticAnalysis(tokens)
+    measure("semantic", analysis.analyze)
+    if any(issue.type == "error" for issue in analysis.issues):
+        raise ValueError("the program has errors")
+
+    program = measure("parse", lambda: FlatProgram.from_tokens(tokens))
+    measure("range", PointerRangeAnalysis(program).analyze)
+    ast = measure(
+        "optimize", lambda: ASTOptimizer(program.to_tree()).optimize())
+    # without partial evaluation, which would run the programs that read no
+    # input inside codegen and leave run only printing constants
+    module = measure("codegen", IRManager(ast, step_budget=0).to_llvm_call_ir)
+
+    jit = JITCompiler(opt_level, verbose=False)
+    binding_module = measure("llvm-opt", lambda: jit.optimize(module))
+    address = measure("jit", lambda: jit.load(binding_module, "bf_call"))
+
+    compiled = Program(jit, address)
+    return measure("run", lambda: compiled(input))
+
+
+def benchmark(source, repeat=3, opt_level=2, input=b""):
+    # the best time of each stage over repeat runs, then one more run for
+    # the memory, since tracing allocations slows python down
+    stages = {stage: {"time": float("inf")} for stage in STAGES}
+
+    def timed(stage, function):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        stages[stage]["time"] = min(stages[stage]["time"], elapsed)
+        return result
+
+    for _ in range(repeat):
+        output = run_stages(source, timed, opt_level, input)
+
+    def traced(stage, function):
+        # python's own peak over what the stage allocates, and the peak of
+        # the whole process so far, which also counts llvm and the compiled
+        # program. tracing starts afresh for every stage, reset_peak needs
+        # python 3.9
+        tracemalloc.start()
+        try:
+            result = function()
+            stages[stage]["python_peak"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        stages[stage]["max_rss"] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss * 1024
+        return result
+
+    run_stages(source, traced, opt_level, input)
+
+    return {"source_size": len(source), "output_size": len(output),
+            "opt_level": opt_level, "stages": stages}
+
+
+def git_commit():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=directory, capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(corpus, repeat=3, opt_level=2, log=None):
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "llvmlite": llvmlite.__version__,
+        "machine": platform.machine(),
+        "opt_level": opt_level,
+        "repeat": repeat,
+        "programs": {},
+    }
+    for name, source in corpus.items():
+        if log is not None:
+            print("{}...".format(name), file=log, flush=True)
+        results["programs"][name] = benchmark(
+            source, repeat, opt_level, INPUTS.get(name, b""))
+    return results
+
+
+def compare(old, new, threshold=DEFAULT_THRESHOLD, noise_floor=NOISE_FLOOR):
+    # the stages that got slower from old to new results, as
+    # (program, stage, old time, new time)
+    regressions = []
+    for name, program in new["programs"].items():
+        if name not in old["programs"]:
+            continue
+        old_stages = old["programs"][name]["stages"]
+        for stage, measurement in program["stages"].items():
+            if stage not in old_stages:
+                continue
+            before, after = old_stages[stage]["time"], measurement["time"]
+            if after > before * (1 + threshold) and after - before > noise_floor:
+                regressions.append((name, stage, before, after))
+    return regressions
+
+
+def print_results(results, file=sys.stdout):
+    print("{:<18}".format("program") + "".join(
+        "{:>10}".format(stage) for stage in STAGES), file=file)
+    for name, program in results["programs"].items():
+        times = program["stages"]
+        print("{:<18}".format(name) + "".join(
+            "{:>10.4f}".format(times[stage]["time"]) for stage in STAGES),
+            file=file)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m compiler.benchmark",
+        description="time and measure every stage of the compiler")
+    parser.add_argument(
+        "programs", nargs="*",
+        help="programs of the corpus to run (default all)")
+    parser.add_argument(
+        "-O", dest="opt_level", type=int, choices=(0, 1, 2, 3), default=2,
+        help="llvm optimization level (default 2)")
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="runs per program, the best time is kept (default 3)")
+    parser.add_argument("-o", dest="output", help="write the results as json")
+    parser.add_argument(
+        "--compare", help="results of an earlier run to check for regressions")
+    parser.add_argument(
+        "--threshold", type=float, default=DEFAULT_THRESHOLD,
+        help="slowdown that counts as a regression (default {})".format(
+            DEFAULT_THRESHOLD))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    corpus = load_corpus(args.programs or None)
+    results = run_benchmarks(corpus, args.repeat, args.opt_level, sys.stderr)
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        for name, stage, before, after in regressions:
+            print("regression: {} {} {:.4f}s -> {:.4f}s".format(
+                name, stage, before, after), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+def test():
+    from .program import compile
+
+    # the generated programs do what they say
+    assert compile(hanoi(3))() == b"ABACABA\n"
+    assert len(compile(hanoi(10))()) == 2 ** 10
+    assert compile(mandelbrot_style())(bytes((3, 2, 2))) == b"!!!\n!\"\"\n"
+    assert compile(load_corpus(["squares"])["squares"])().endswith(b"9801\n10000\n")
+
+    corpus = {"hello": load_corpus(["hello"])["hello"],
+              "deep-nesting": deep_nesting(100),
+              "huge-source": huge_source(2 ** 16, copies=4)}
+    results = run_benchmarks(corpus, repeat=1)
+    hello = results["programs"]["hello"]
+    assert hello["output_size"] == len(b"Hello World!\n")
+    assert set(hello["stages"]) == set(STAGES)
+    assert all(stage["python_peak"] > 0 for stage in hello["stages"].values())
+    print_results(results)
+
+    # the fractal is the runtime workload, its run stage has to do the steps
+    # rather than print a picture worked out at compile time. every character
+    # is 32 plus the steps of its point, and there are over a million
+    source = mandelbrot_style()
+    input = INPUTS["mandelbrot-style"]
+    output = compile(source)(input)
+    width, height = input[:2]
+    assert sum(output) - 32 * width * height - 10 * height > 10 ** 6
+    fractal = run_benchmarks({"mandelbrot-style": source}, repeat=1)
+    run = fractal["programs"]["mandelbrot-style"]["stages"]["run"]
+    assert run["time"] > NOISE_FLOOR, run
+
+    # the results survive json, and a stage that got twice as slow is flagged
+    old = json.loads(json.dumps(results))
+    assert compare(old, results) == []
+    old["programs"]["hello"]["stages"]["codegen"]["time"] = (
+        hello["stages"]["codegen"]["time"] / 2 - NOISE_FLOOR)
+    assert [regression[:2] for regression in compare(old, results)] == [
+        ("hello", "codegen")]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
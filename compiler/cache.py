@@ -0,0 +1,121 @@
+# on-disk cache of compiled object code, so programs we have already compiled
+# can skip parsing, code generation and llvm entirely
+# https://llvmlite.readthedocs.io/en/latest/user-guide/binding/execution-engine.html
+
+import hashlib
+import os
+import tempfile
+
+import llvmlite
+
+
+DEFAULT_MAX_SIZE = 256 * 2 ** 20
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "bfcompiler")
+
+
+def compiler_version():
+    # a stamp of the compiler sources and llvm version, so entries compiled by
+    # an older version of the compiler are never reused
+    digest = hashlib.sha256(llvmlite.__version__.encode())
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".py"):
+            with open(os.path.join(directory, name), "rb") as f:
+                digest.update(name.encode())
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+class ObjectCache:
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE) -> None:
+        self.directory = directory or default_cache_dir()
+        self.max_size = max_size
+        self.version = compiler_version()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, tokens, **settings):
+        # hash of the token stream and every setting that changes the output
+        digest = hashlib.sha256(self.version.encode())
+        for name in sorted(settings):
+            digest.update("{}={};".format(name, settings[name]).encode())
+        if isinstance(tokens, (bytes, bytearray)):
+            digest.update(tokens)
+        else:
+            digest.update("".join(tokens).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".o")
+
+    def load(self, key):
+        try:
+            with open(self.path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        # mark the entry as recently used for eviction
+        os.utime(self.path(key))
+        return data
+
+    def store(self, key, data):
+        # write to a temporary file first so readers never see partial entries
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        # drop the least recently used entries until we fit in max_size
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".o"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".o"):
+                os.remove(os.path.join(self.directory, name))
+
+
+def test():
+    cache = ObjectCache(tempfile.mkdtemp(), max_size=10)
+
+    key = cache.key(["+", "."], opt_level=2)
+    assert key != cache.key(["+", "."], opt_level=3)
+    assert cache.load(key) is None
+
+    cache.store(key, b"12345")
+    assert cache.load(key) == b"12345"
+
+    # storing past max_size evicts the oldest entry
+    other = cache.key(["-"], opt_level=2)
+    os.utime(cache.path(key), (0, 0))
+    cache.store(other, b"1234567")
+    assert cache.load(key) is None
+    assert cache.load(other) == b"1234567"
+
+
+if __name__ == "__main__":
+    test()
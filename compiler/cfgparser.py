@@ -4,7 +4,6 @@
 # https://tuckyou.in/2016/05/27/brainfuq-a-brainfuck-interpreter/
 
 from typing import Literal
-from graphviz import Digraph
 from .lexer import BFLexer
 
 # program -> (loop | operation)*
@@ -23,18 +22,27 @@ from .lexer import BFLexer
 
 # a node in our AST
 class BrainFuckNode:
-    def __init__(self, value, char_index, children=None, ):
+    def __init__(self, value, char_index, children=None, amount=0, offset=0):
         self.value: Literal["Loop", "Program", "LoopEnd",
-                            "<", ">", ".", ",", "+", "-"] = value
+                            "<", ">", ".", ",", "+", "-",
+                            "Add", "Move", "Clear", "MulAdd", "Scan",
+                            "Set"] = value
         self.children = children or []
         self.parent = None
         self.char_index = char_index
+        # operands of the nodes produced by the optimizer
+        self.amount = amount
+        self.offset = offset
 
     def add_child(self, child):
         child.parent = self
         self.children.append(child)
 
     def __str__(self):
+        if self.value in ("Add", "Move", "Scan"):
+            return "{}({})".format(self.value, self.amount)
+        elif self.value in ("MulAdd", "Set"):
+            return "{}({}, {})".format(self.value, self.offset, self.amount)
         return self.value
 
     def getValue(self):
@@ -46,47 +54,67 @@ class BrainFuckNode:
 
 class BrainfuckParser:
     def __init__(self, code):
+        # the fast lexer gives us bytes, a str indexes the same as a token list
+        if isinstance(code, (bytes, bytearray)):
+            code = code.decode("ascii")
         self.code = code
         self.ptr = 0
 
     def parse_program(self):
-        nodes = []
+        root = BrainFuckNode("Program", self.ptr)
+        self.parse_into(root)
+        root.char_index = self.ptr
+        return root
+
+    def parse_into(self, node):
+        # parse nodes into node until its closing ] or the end of the code,
+        # the open loops are kept on a stack so deep nesting can't overflow
+        # python's recursion limit
+        stack = [node]
         while self.ptr < len(self.code):
             char = self.code[self.ptr]
-            # perform recursive parsing depending on the type of instruction
+            # perform parsing depending on the type of instruction
             if char in (">", "<", "+", "-", ".", ","):
-                nodes.append(self.parse_command())
+                stack[-1].add_child(self.parse_command())
             elif char == "[":
-                nodes.append(self.parse_loop())
+                loop = BrainFuckNode("Loop", self.ptr)
+                stack[-1].add_child(loop)
+                stack.append(loop)
+                self.ptr += 1  # Skip the opening '['
             elif char == ']':
-                nodes.append(BrainFuckNode("LoopEnd", self.ptr))
-                return BrainFuckNode("Program", self.ptr, nodes)
+                stack[-1].add_child(BrainFuckNode("LoopEnd", self.ptr))
+                if len(stack) == 1:
+                    return
+                stack.pop()
+                self.ptr += 1  # Skip the closing ']'
             else:
-                assert AssertionError
-
-        return BrainFuckNode("Program", self.ptr, nodes)
+                self.ptr += 1
 
+    # char_index is the index of the node's token, the [ for loops
     def parse_command(self):
         char = self.code[self.ptr]
+        node = BrainFuckNode(char, self.ptr)
         self.ptr += 1
-        return BrainFuckNode(char, self.ptr)
-
-    def parse_loop(self):
-        self.ptr += 1  # Skip the opening '['
-        loop_nodes = self.parse_program()
-        self.ptr += 1  # Skip the closing ']'
-        return BrainFuckNode("Loop", self.ptr, loop_nodes.children)
+        return node
 
 
 # function to draw the ast as a digraph to a png using graphviz
 def visualize_tree(node: BrainFuckNode, dot=None):
+    # imported here so the compiler works without graphviz installed
+    from graphviz import Digraph
+
     if dot is None:
         dot = Digraph(format="png")
-    dot.node(str(id(node)), label=node.value)
 
-    for child in node.children:
-        dot.edge(str(id(node)), str(id(child)))
-        visualize_tree(child, dot)
+    # walk the tree with a stack rather than recursion
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        dot.node(str(id(node)), label=str(node))
+
+        for child in node.children:
+            dot.edge(str(id(node)), str(id(child)))
+        stack.extend(reversed(node.children))
     return dot
 
 
@@ -2,154 +2,822 @@
 # but changed to support our ast structure
 
 
+import mmap
+
 from llvmlite import ir, binding as llvm
-from .cfgparser import BrainfuckParser, BrainFuckNode
+from .cfgparser import BrainfuckParser
 from .lexer import BFLexer
-
-
-INDEX_BIT_SIZE = 16
+from .optimizer import ASTOptimizer, CELL_BIT_SIZE, INDEX_BIT_SIZE
+from .runtime import IORuntime, io_state_type, declare_external
+from .debug_info import DebugInfo
+from .range_analysis import PointerRangeAnalysis
+from .partial_eval import PartialEvaluator, DEFAULT_STEP_BUDGET
+from .flatprogram import (FlatProgram, ADD, MOVE, OUTPUT, INPUT, OPEN, CLOSE,
+                          CLEAR, MULADD, SCAN, SET)
+
+
+# what , stores in the cell once the input runs out
+EOF_BEHAVIORS = ("zero", "minus_one", "unchanged")
+
+CELL_BIT_SIZES = (8, 16, 32)
+
+# tapes up to this many bytes go on the stack, bigger ones are mapped
+STACK_TAPE_SIZE = 2 ** 12
+# guard regions are a multiple of this, which is a multiple of the page size
+GUARD_ALIGNMENT = 2 ** 16
+# tape snapshots with up to this many nonzero cells are stored one at a time,
+# bigger ones are copied from a constant
+SNAPSHOT_STORES = 64
+
+# llvm takes time that grows faster than linearly with the size of a function
+# and exponentially with the depth of its loop nests, so loops of at least
+# OUTLINE_SIZE ops or nested MAX_NEST_DEPTH deep are compiled into functions
+# of their own, and so is the rest of any function past OUTLINE_SIZE ops, a
+# segment at a time. this keeps compile time linear in the program size
+OUTLINE_SIZE = 2 ** 10
+MAX_NEST_DEPTH = 8
+# split programs put about this many ops worth of functions in each module
+MODULE_SIZE = 2 ** 14
+
+# the ops counted by the profile and the character each is written out as
+PROFILED_OPS = {OPEN: ord("["), OUTPUT: ord("."), INPUT: ord(",")}
+
+MAP_FLAGS = (mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS
+             | getattr(mmap, "MAP_NORESERVE", 0))
+PROT_NONE = 0
+PROT_READ_WRITE = mmap.PROT_READ | mmap.PROT_WRITE
+
+byte = ir.IntType(8)
+int32 = ir.IntType(32)
+size_t = ir.IntType(64)
+void = ir.VoidType()
+index_type = ir.IntType(INDEX_BIT_SIZE)
+
+zero8 = byte(0)
+one8 = byte(1)
+eof = int32(-1)
 
 
 class IRManager:
-    def __init__(self, ast) -> None:
+    def __init__(self, ast, buffered_io=True, eof_behavior="zero",
+                 range_analysis=True, cell_bits=CELL_BIT_SIZE,
+                 tape_bits=INDEX_BIT_SIZE, guard_pages=False,
+                 step_budget=DEFAULT_STEP_BUDGET, profile=None,
+                 outline_loops=False, outline_size=OUTLINE_SIZE,
+                 debug_source=None) -> None:
+        if eof_behavior not in EOF_BEHAVIORS:
+            raise ValueError(
+                "eof_behavior must be one of {}".format(EOF_BEHAVIORS))
+        if cell_bits not in CELL_BIT_SIZES:
+            raise ValueError(
+                "cell_bits must be one of {}".format(CELL_BIT_SIZES))
+        if tape_bits < 1:
+            raise ValueError("tape_bits must be at least 1")
         self.ast = ast
-        pass
+        self.buffered_io = buffered_io
+        self.eof_behavior = eof_behavior
+        self.range_analysis = range_analysis
+        # ops the partial evaluator may run at compile time, 0 turns it off
+        self.step_budget = step_budget
+        # a file main writes the number of times every loop, . and , ran to
+        # before it returns, see write_profile. nothing runs at compile time
+        # then, so the counts cover the whole run
+        self.profile = profile
+        # the counter of each profiled op, by op index
+        self.profile_slots = None
+        # every loop becomes a function of its own named after the token
+        # index of its [, so native profilers can tell the loops apart
+        self.outline_loops = outline_loops
+        # otherwise functions are split up by the OUTLINE_SIZE policy, with
+        # outline_size in place of OUTLINE_SIZE, None turns it off
+        self.outline_size = outline_size
+        # loops open in the function being built, the ops in it so far, and
+        # the caller to return to if it is a segment, see split_function
+        self.depth = 0
+        self.function_ops = 0
+        self.segment = None
+        # the names of the entry and outlined functions, which are unique
+        # across modules
+        self.function_names = set()
+        # with split, the outlined functions go in modules of their own so
+        # llvm can compile them separately, see to_llvm_modules
+        self.split = False
+        self.modules = []
+        self.module_size = 0
+        # the runtime and libc functions of each module
+        self.declarations = {}
+        # the source file, when the code should have line tables pointing
+        # back into it, and the debug info scope of the function being built
+        self.debug_source = debug_source
+        self.debug = None
+        self.scope = None
+
+        # the data pointer is kept as an ssa value instead of in an alloca,
+        # pointer moves only bump a compile time offset which gets folded into
+        # the tape accesses, and is added to the pointer at loop boundaries
+        self.pointer = None
+        self.offset = 0
+
+        self.cell_bits = cell_bits
+        self.cell_type = ir.IntType(cell_bits)
+
+        # the tape is 2 ** tape_bits cells and the pointer is a tape_bits wide
+        # integer, so it wraps around the tape for free. with guard pages the
+        # pointer is native width instead, and running off the tape faults.
+        # programs that provably stay on the tape get a tape just big enough
+        # and a native width pointer
+        self.tape_size = 2 ** tape_bits
+        self.guard_pages = guard_pages
+        self.wraps = not guard_pages
+        self.index_type = ir.IntType(tape_bits) if self.wraps else size_t
+        # the mapping holding the tape and its size, None for stack tapes
+        self.mapping = None
 
     def to_llvm_ir(self):
-        ast = self.ast
-
-        byte = ir.IntType(8)
-        int32 = ir.IntType(32)
-        size_t = ir.IntType(64)
-
-        void = ir.VoidType()
-
         module = ir.Module(name=__file__)
         main_type = ir.FunctionType(int32, ())
         main_func = ir.Function(module, main_type, name="main")
         entry = main_func.append_basic_block(name="entry")
+        self.entry = main_func
+        self.function_names.add("main")
 
-        builder = ir.IRBuilder(entry)
+        self.builder = ir.IRBuilder(entry)
+        self.start_debug_info(module, main_func)
+        self.declare_functions(module)
+        self.compile_main(module)
 
-        putchar_type = ir.FunctionType(int32, (int32,))
-        putchar = ir.Function(module, putchar_type, name="putchar")
+        # print the llvm ir
+        return module
 
-        getchar_type = ir.FunctionType(int32, ())
-        getchar = ir.Function(module, getchar_type, name="getchar")
+    def to_llvm_modules(self):
+        # the program as a main module and modules holding its outlined
+        # loops, which are compiled one by one (or all at once, see
+        # LLVMCompiler.emit_objects) and linked together. a profile or debug
+        # info needs everything in one module
+        self.split = self.profile is None and self.debug_source is None
+        return [self.to_llvm_ir()] + self.modules
+
+    def to_llvm_call_modules(self, name="bf_call"):
+        # the same for to_llvm_call_ir
+        self.split = self.profile is None and self.debug_source is None
+        return [self.to_llvm_call_ir(name)] + self.modules
+
+    def to_llvm_call_ir(self, name="bf_call"):
+        # the whole program as a reentrant function on in-memory input and
+        # output, i32 name(io_state* io) returns like main. the tape is local
+        # to the call and all io goes through io, so any number of calls can
+        # run at once
+        module = ir.Module(name=__file__)
+        function_type = ir.FunctionType(int32, (io_state_type.as_pointer(),))
+        function = ir.Function(module, function_type, name=name)
+        entry = function.append_basic_block(name="entry")
+        self.entry = function
+        self.function_names.add(name)
+
+        self.builder = ir.IRBuilder(entry)
+        self.start_debug_info(module, function)
+        self.declare_functions(module, memory_io=True)
+        self.runtime.bind(function.args[0])
+        self.compile_main(module)
 
-        bzero_type = ir.FunctionType(void, (byte.as_pointer(), size_t))
-        bzero = ir.Function(module, bzero_type, name="bzero")
+        return module
 
-        index_type = ir.IntType(INDEX_BIT_SIZE)
-        index = builder.alloca(index_type)
-        builder.store(ir.Constant(index_type, 0), index)
-
-        tape_type = byte
-        tape = builder.alloca(tape_type, size=2 ** INDEX_BIT_SIZE)
-        builder.call(bzero, (tape, size_t(2 ** INDEX_BIT_SIZE)))
-
-        zero8 = byte(0)
-        one8 = byte(1)
-
-        eof = int32(-1)
-
-        def get_tape_location():
-            index_value = builder.load(index)
-            index_value = builder.zext(index_value, int32)
-            location = builder.gep(tape, (index_value,), inbounds=True)
-            return location
-
-        def compile_instruction(instruction: BrainFuckNode):
-            if instruction.value == "Loop":
-                # append a llvm loop block
-                preloop = builder.append_basic_block(name="preloop")
-                # branch into the block
-                builder.branch(preloop)
-                # go to the start position of the loop
-                builder.position_at_start(preloop)
-
-                location = get_tape_location()
-                tape_value = builder.load(location)
-
-                is_zero = builder.icmp_unsigned("==", tape_value, zero8)
-                # add a body block so we can dump the looop contents and recurse
-                body = builder.append_basic_block(name="body")
-                builder.position_at_start(body)
-                for child in instruction.children:
-                    if child.value != "LoopEnd":
-                        # compile any valid nodes
-                        compile_instruction(child)
-
-                # branch back out, to the upper level after processing child nodes
-                builder.branch(preloop)
-
-                # go out of the loop
-                postloop = builder.append_basic_block(name="postloop")
-
-                builder.position_at_end(preloop)
-                builder.cbranch(is_zero, postloop, body)
-
-                builder.position_at_start(postloop)
-            elif instruction.value == "+" or instruction.value == "-":
-                location = get_tape_location()
-                value = builder.load(location)
-                # add or subtract 1 from the value
-                if instruction.value == "+":
-                    new_value = builder.add(value, one8)
-                else:
-                    new_value = builder.sub(value, one8)
-
-                builder.store(new_value, location)
-            elif instruction.value == ">" or instruction.value == "<":
-                index_value = builder.load(index)
-                # add or subtract 1 from the index i.e move pointer left or right
-                if instruction.value == ">":
-                    index_value = builder.add(index_value, index_type(1))
-                else:
-                    index_value = builder.sub(index_value, index_type(1))
-
-                builder.store(index_value, index)
-
-            elif instruction.value == ".":
-                # print the value at the current tape location
-                location = get_tape_location()
-                tape_value = builder.load(location)
-                tape_value = builder.zext(tape_value, int32)
-
-                builder.call(putchar, (tape_value,))
-            elif instruction.value == ",":
-                #  read a character from stdin and store it at the current tape location
-                location = get_tape_location()
-
-                char = builder.call(getchar, ())
-                is_eof = builder.icmp_unsigned("==", char, eof)
-
-                with builder.if_else(is_eof) as (then, otherwise):
-                    with then:
-                        builder.store(zero8, location)
-
-                    with otherwise:
-                        char = builder.trunc(char, tape_type)
-                        builder.store(char, location)
-
-        # compile the ast recursively
-        for instruction in ast.children:
-            compile_instruction(instruction)
+    def compile_main(self, module):
+        # the body of main, from partial evaluation to the return
+        builder = self.builder
+        program = self.get_program()
+        start = 0
+        snapshot = {}
+        output = b""
+        if self.step_budget and self.profile is None:
+            # the part of the program that doesn't need input is run now, the
+            # rest starts from the tape it left behind
+            evaluator = PartialEvaluator(
+                program, self.step_budget, self.cell_bits, self.tape_size,
+                self.wraps).run()
+            program = evaluator.residual()
+            start = evaluator.pointer
+            snapshot = evaluator.tape
+            output = bytes(evaluator.output)
+
+        if output:
+            self.write_constant(module, output)
+
+        # a program that ran to the end needs no tape at all
+        if len(program):
+            if self.range_analysis:
+                self.fit_tape(program, start, snapshot)
+
+            self.pointer = self.index_type(start)
+            self.offset = 0
+
+            self.allocate_tape()
+            self.store_snapshot(module, snapshot)
+
+            if self.profile is not None:
+                self.declare_profile(module, program)
+            self.compile_program(program)
+
+        # write out whatever output is still buffered
+        self.runtime.call(builder, self.runtime.flush)
+        if self.mapping is not None:
+            builder.call(self.munmap, self.mapping)
+        if self.profile is not None:
+            self.write_profile(module)
 
         # add a return statement
         builder.ret(int32(0))
 
-        # print the llvm ir
+    def to_llvm_function_ir(self, name="bf_run"):
+        # the program as a function that runs on the caller's tape, starting
+        # at the given pointer and returning where the pointer ends up:
+        # i16 name(i8* tape, i16 pointer) with the default widths
+        module = ir.Module(name=__file__)
+        function_type = ir.FunctionType(
+            self.index_type, (self.cell_type.as_pointer(), self.index_type))
+        function = ir.Function(module, function_type, name=name)
+        entry = function.append_basic_block(name="entry")
+        self.entry = function
+        self.function_names.add(name)
+
+        self.builder = builder = ir.IRBuilder(entry)
+        self.declare_functions(module)
+
+        self.tape, self.pointer = function.args
+        self.offset = 0
+
+        self.compile_program(self.get_program())
+
+        self.runtime.call(builder, self.runtime.flush)
+        self.materialize_pointer()
+        builder.ret(self.pointer)
+
         return module
 
+    def start_debug_info(self, module, function):
+        # everything up to the first op is put down to the start of the source
+        if self.debug_source is None:
+            return
+        self.debug = DebugInfo(module, self.debug_source)
+        self.scope = self.debug.subprogram(function)
+        self.builder.debug_metadata = self.debug.location(0, self.scope)
+
+    def should_outline(self, program: FlatProgram, index):
+        # whether the loop opening at index gets a function of its own
+        if self.outline_loops:
+            return True
+        if self.outline_size is None:
+            return False
+        return (self.depth >= MAX_NEST_DEPTH
+                or program.jumps[index] - index >= self.outline_size)
+
+    def split_function(self, program: FlatProgram, index):
+        # once a function has grown to outline_size ops, the rest of its code
+        # goes in segments of about that size, functions of their own the
+        # function calls one after the other. a segment ends early at the ]
+        # of a loop it isn't in
+        if self.outline_size is None:
+            return
+        op = program.ops[index]
+        if self.segment is not None and self.depth == 0 and (
+                op == CLOSE or self.function_ops >= self.outline_size):
+            self.return_to(self.segment)
+        if (self.segment is None and op != CLOSE
+                and self.function_ops >= self.outline_size):
+            self.segment = self.outline(program, index, "bf_code")
+
+    def outline(self, program: FlatProgram, index, kind="bf_loop"):
+        # the code from index on goes in a function of its own,
+        # index_type <kind>_<position>(cell* tape, index_type pointer) which
+        # returns the pointer at the end of it, with the io state as well in
+        # memory mode, position being the token index of the op. the caller
+        # calls it once the code has been compiled, see return_to, which
+        # needs what this returns
+        self.materialize_pointer()
+        caller_module = self.builder.module
+        module = caller_module
+        if self.split and self.builder.function is self.entry:
+            module = self.next_module()
+
+        arguments = (self.cell_type.as_pointer(), self.index_type)
+        if self.runtime.memory:
+            arguments += (io_state_type.as_pointer(),)
+        function_type = ir.FunctionType(self.index_type, arguments)
+
+        name = base = "{}_{}".format(kind, program.positions[index])
+        while name in self.function_names:
+            name = "{}.{}".format(base, len(self.function_names))
+        self.function_names.add(name)
+
+        function = ir.Function(module, function_type, name=name)
+        # llvm would inline it straight back into the caller otherwise
+        function.attributes.add("noinline")
+        callee = function
+        if module is caller_module:
+            function.linkage = "internal"
+        else:
+            callee = ir.Function(caller_module, function_type, name=name)
+
+        caller = (callee, self.builder, self.tape, self.pointer,
+                  self.runtime.io, self.scope, self.depth, self.function_ops,
+                  self.segment)
+        self.builder = ir.IRBuilder(function.append_basic_block(name="entry"))
+        self.use_declarations(module)
+        self.tape, self.pointer = function.args[:2]
+        self.depth = self.function_ops = 0
+        self.segment = None
+        if self.runtime.memory:
+            self.runtime.bind(function.args[2])
+        if self.debug is not None:
+            self.scope = self.debug.subprogram(
+                function, program.positions[index])
+        return caller
+
+    def return_to(self, caller):
+        # finish the outlined function and call it from where its code was
+        self.materialize_pointer()
+        self.builder.ret(self.pointer)
+
+        (function, self.builder, self.tape, pointer, io, self.scope,
+         self.depth, self.function_ops, self.segment) = caller
+        self.use_declarations(self.builder.module)
+        arguments = (self.tape, pointer)
+        if self.runtime.memory:
+            self.runtime.bind(io)
+            arguments += (io,)
+        self.pointer = self.builder.call(function, arguments)
+
+    def next_module(self):
+        # the module for a function outlined from the entry point, a new one
+        # once the last one is full
+        if not self.modules or self.module_size >= MODULE_SIZE:
+            module = ir.Module(name="{}:{}".format(__file__, len(self.modules)))
+            self.declare_functions(
+                module, self.runtime.memory, buffers="imported")
+            self.use_declarations(self.builder.module)
+            self.modules.append(module)
+            self.module_size = 0
+        return self.modules[-1]
+
+    def use_declarations(self, module):
+        # switch to the runtime and libc functions of module
+        (self.runtime, self.bzero, self.memchr, self.memrchr, self.memcpy,
+         self.mmap, self.mprotect, self.munmap) = self.declarations[module]
+
+    def fit_tape(self, program: FlatProgram, start=0, snapshot=None):
+        # size the tape to the cells the program can touch, if they are known
+        if snapshot is None:
+            snapshot = {}
+        analysis = PointerRangeAnalysis(program, self.tape_size, start)
+        analysis.analyze()
+        if not analysis.in_bounds():
+            return
+
+        cells = analysis.cells or (start, start)
+        self.index_type = size_t
+        self.tape_size = max(cells[1], max(snapshot, default=0)) + 1
+        self.wraps = False
+        self.guard_pages = False
+
+    def allocate_tape(self):
+        # small tapes go on the stack, bigger ones are an anonymous mapping
+        # the kernel zeroes a page at a time as it gets used, so the start up
+        # cost doesn't grow with the tape
+        builder = self.builder
+        size = self.tape_size * self.cell_bits // 8
+
+        if size <= STACK_TAPE_SIZE and not self.guard_pages:
+            self.tape = builder.alloca(self.cell_type, size=self.tape_size)
+            start = builder.bitcast(self.tape, byte.as_pointer())
+            builder.call(self.bzero, (start, size_t(size)))
+            return
+
+        # with guard pages the tape sits between two inaccessible regions as
+        # big as itself, so running off either end faults
+        guard = 0
+        protection = PROT_READ_WRITE
+        if self.guard_pages:
+            size = -(-size // GUARD_ALIGNMENT) * GUARD_ALIGNMENT
+            guard = size
+            protection = PROT_NONE
+
+        length = size_t(size + 2 * guard)
+        mapping = builder.call(self.mmap, (
+            ir.Constant(byte.as_pointer(), None), length, int32(protection),
+            int32(MAP_FLAGS), int32(-1), size_t(0)))
+
+        failed = builder.icmp_unsigned(
+            "==", mapping, builder.inttoptr(size_t(-1), byte.as_pointer()))
+        with builder.if_then(failed, likely=False):
+            builder.ret(int32(1))
+
+        start = builder.gep(mapping, (size_t(guard),), inbounds=True)
+        if self.guard_pages:
+            status = builder.call(
+                self.mprotect, (start, size_t(size), int32(PROT_READ_WRITE)))
+            failed = builder.icmp_signed("!=", status, int32(0))
+            with builder.if_then(failed, likely=False):
+                builder.call(self.munmap, (mapping, length))
+                builder.ret(int32(1))
+
+        self.tape = builder.bitcast(start, self.cell_type.as_pointer())
+        self.mapping = (mapping, length)
+
+    def store_snapshot(self, module, snapshot):
+        # fill in the cells the partial evaluator left nonzero
+        builder = self.builder
+        if len(snapshot) <= SNAPSHOT_STORES:
+            for index, value in sorted(snapshot.items()):
+                location = builder.gep(self.tape, (size_t(index),), inbounds=True)
+                builder.store(self.cell_type(value), location)
+            return
+
+        low, high = min(snapshot), max(snapshot)
+        cells = ir.ArrayType(self.cell_type, high - low + 1)
+        values = ir.GlobalVariable(module, cells, name="bf_tape_snapshot")
+        values.linkage = "private"
+        values.global_constant = True
+        values.initializer = ir.Constant(
+            cells, [snapshot.get(index, 0) for index in range(low, high + 1)])
+
+        target = builder.gep(self.tape, (size_t(low),), inbounds=True)
+        builder.call(self.memcpy, (
+            builder.bitcast(target, byte.as_pointer()),
+            builder.bitcast(values, byte.as_pointer()),
+            size_t(cells.count * self.cell_bits // 8)))
+
+    def write_constant(self, module, data):
+        # output that is known at compile time goes out in a single write
+        text = ir.ArrayType(byte, len(data))
+        constant = ir.GlobalVariable(module, text, name="bf_static_output")
+        constant.linkage = "private"
+        constant.global_constant = True
+        constant.initializer = ir.Constant(text, bytearray(data))
+
+        self.runtime.call(self.builder, self.runtime.flush)
+        self.runtime.call(
+            self.builder, self.runtime.write_all,
+            self.builder.bitcast(constant, byte.as_pointer()), size_t(len(data)))
+
+    def declare_profile(self, module, program: FlatProgram):
+        # a zeroed counter for every [ . and , in the program, with the kind
+        # and token index of each one next to it for write_profile
+        slots = [index for index in range(len(program))
+                 if program.ops[index] in PROFILED_OPS]
+        self.profile_slots = {index: slot for slot, index in enumerate(slots)}
+
+        counts = ir.ArrayType(size_t, len(slots))
+        self.profile_counts = ir.GlobalVariable(
+            module, counts, name="bf_profile_counts")
+        self.profile_counts.linkage = "internal"
+        self.profile_counts.initializer = ir.Constant(counts, None)
+
+        self.profile_kinds = self.private_constant(
+            module, "bf_profile_kinds", byte,
+            [PROFILED_OPS[program.ops[index]] for index in slots])
+        self.profile_positions = self.private_constant(
+            module, "bf_profile_positions", size_t,
+            [program.positions[index] for index in slots])
+
+    def count_op(self, index):
+        # one more run of the op, if it is being profiled
+        if self.profile_slots is None:
+            return
+        builder = self.builder
+        counter = builder.gep(self.profile_counts, (
+            int32(0), int32(self.profile_slots[index])), inbounds=True)
+        builder.store(builder.add(builder.load(counter), size_t(1)), counter)
+
+    def write_profile(self, module):
+        # one line per counter, "<kind> <token index> <count>", the format
+        # compiler.profile reads
+        builder = self.builder
+        pointer = byte.as_pointer()
+        fopen = declare_external(module, "fopen", ir.FunctionType(
+            pointer, (pointer, pointer)))
+        fprintf = declare_external(module, "fprintf", ir.FunctionType(
+            int32, (pointer, pointer), var_arg=True))
+        fclose = declare_external(module, "fclose", ir.FunctionType(
+            int32, (pointer,)))
+
+        def string(name, text):
+            data = bytearray(text.encode() + b"\0")
+            return builder.bitcast(
+                self.private_constant(module, name, byte, data), pointer)
+
+        file = builder.call(fopen, (
+            string("bf_profile_path", self.profile), string("bf_profile_mode", "w")))
+        opened = builder.icmp_unsigned("!=", file, ir.Constant(pointer, None))
+        with builder.if_then(opened):
+            line = string("bf_profile_line", "%c %llu %llu\n")
+            slots = len(self.profile_slots or ())
+            if slots:
+                preheader = builder.block
+                write = builder.append_basic_block(name="profile")
+                builder.branch(write)
+                builder.position_at_start(write)
+
+                slot = builder.phi(size_t)
+                slot.add_incoming(size_t(0), preheader)
+                values = [builder.load(builder.gep(
+                    table, (size_t(0), slot), inbounds=True)) for table in (
+                    self.profile_kinds, self.profile_positions,
+                    self.profile_counts)]
+                # %c takes an int, varargs are not promoted for us
+                values[0] = builder.zext(values[0], int32)
+                builder.call(fprintf, (file, line, *values))
+
+                next_slot = builder.add(slot, size_t(1))
+                slot.add_incoming(next_slot, builder.block)
+                done = builder.append_basic_block(name="profiled")
+                builder.cbranch(
+                    builder.icmp_unsigned("<", next_slot, size_t(slots)),
+                    write, done)
+                builder.position_at_start(done)
+            builder.call(fclose, (file,))
+
+    def private_constant(self, module, name, element_type, values):
+        array_type = ir.ArrayType(element_type, len(values))
+        constant = ir.GlobalVariable(module, array_type, name=name)
+        constant.linkage = "private"
+        constant.global_constant = True
+        constant.initializer = ir.Constant(array_type, values)
+        return constant
+
+    def get_program(self):
+        # trees are flattened first, so there's a single code path
+        if isinstance(self.ast, FlatProgram):
+            return self.ast
+        return FlatProgram.from_tree(self.ast, self.cell_bits)
+
+    def declare_functions(self, module, memory_io=False, buffers=None):
+        # the functions generated code calls, for the modules of a split
+        # program the io buffers of the main module are shared by all
+        if buffers is None:
+            buffers = "external" if self.split else "internal"
+        runtime = IORuntime(
+            module, buffered=self.buffered_io, memory=memory_io,
+            buffers=buffers)
+
+        bzero_type = ir.FunctionType(void, (byte.as_pointer(), size_t))
+        bzero = ir.Function(module, bzero_type, name="bzero")
+
+        memchr_type = ir.FunctionType(
+            byte.as_pointer(), (byte.as_pointer(), int32, size_t))
+        memchr = ir.Function(module, memchr_type, name="memchr")
+        memrchr = ir.Function(module, memchr_type, name="memrchr")
+
+        memcpy_type = ir.FunctionType(
+            byte.as_pointer(), (byte.as_pointer(), byte.as_pointer(), size_t))
+        memcpy = declare_external(module, "memcpy", memcpy_type)
+
+        mmap_type = ir.FunctionType(byte.as_pointer(), (
+            byte.as_pointer(), size_t, int32, int32, int32, size_t))
+        mmap = ir.Function(module, mmap_type, name="mmap")
+        mprotect_type = ir.FunctionType(int32, (byte.as_pointer(), size_t, int32))
+        mprotect = ir.Function(module, mprotect_type, name="mprotect")
+        munmap_type = ir.FunctionType(int32, (byte.as_pointer(), size_t))
+        munmap = ir.Function(module, munmap_type, name="munmap")
+
+        self.declarations[module] = (
+            runtime, bzero, memchr, memrchr, memcpy, mmap, mprotect, munmap)
+        self.use_declarations(module)
+
+    def get_tape_location(self, offset=0):
+        # address of the cell at the pointer plus any pending offset
+        index_value = self.pointer
+        offset = self.wrap(self.offset + offset)
+        if offset != 0:
+            index_value = self.builder.add(
+                index_value, self.index_type(offset))
+
+        index_value = self.cast_index(index_value, size_t)
+        return self.builder.gep(self.tape, (index_value,), inbounds=True)
+
+    def materialize_pointer(self):
+        # apply the pending offset to the pointer value
+        offset = self.wrap(self.offset)
+        if offset != 0:
+            self.pointer = self.builder.add(
+                self.pointer, self.index_type(offset))
+        self.offset = 0
+
+    def cast_index(self, value, type):
+        # zero extend or truncate an integer, if it isn't already of type
+        if value.type.width < type.width:
+            return self.builder.zext(value, type)
+        if value.type.width > type.width:
+            return self.builder.trunc(value, type)
+        return value
+
+    def wrap(self, offset):
+        # pointer offsets wrap around the tape, unless the pointer can't leave it
+        if self.wraps:
+            return offset % self.tape_size
+        return offset
+
+    def compile_program(self, program: FlatProgram):
+        # the program is compiled in order, the open loops are kept on a stack
+        # of (pointer phi, preloop, body, is_zero, caller) so nesting isn't
+        # limited by python's recursion, caller is set for outlined loops
+        loops = []
+        for index in range(len(program)):
+            self.split_function(program, index)
+            self.compile_op(program, index, loops)
+        if self.segment is not None:
+            self.return_to(self.segment)
+
+    def compile_op(self, program: FlatProgram, index, loops):
+        op = program.ops[index]
+        amount = program.amounts[index]
+        self.function_ops += 1
+        self.module_size += 1
+        self.locate(program.positions[index])
+        builder = self.builder
+
+        if op == OPEN:
+            self.materialize_pointer()
+            caller = None
+            if self.should_outline(program, index):
+                caller = self.outline(program, index)
+                self.locate(program.positions[index])
+                builder = self.builder
+            self.depth += 1
+
+            # append a llvm loop block
+            preheader = builder.block
+            preloop = builder.append_basic_block(name="preloop")
+            # branch into the block
+            builder.branch(preloop)
+            # go to the start position of the loop
+            builder.position_at_start(preloop)
+
+            # the pointer either comes from before the loop or from the end of
+            # the previous iteration
+            pointer = builder.phi(self.index_type)
+            pointer.add_incoming(self.pointer, preheader)
+            self.pointer = pointer
+
+            location = self.get_tape_location()
+            tape_value = builder.load(location)
+
+            is_zero = builder.icmp_unsigned(
+                "==", tape_value, self.cell_type(0))
+            # add a body block so we can dump the looop contents
+            body = builder.append_basic_block(name="body")
+            builder.position_at_start(body)
+            self.count_op(index)
+            loops.append((pointer, preloop, body, is_zero, caller))
+        elif op == CLOSE:
+            pointer, preloop, body, is_zero, caller = loops.pop()
+            self.depth -= 1
+
+            self.materialize_pointer()
+            pointer.add_incoming(self.pointer, builder.block)
+
+            # branch back out, to the upper level after processing child nodes
+            builder.branch(preloop)
+
+            # go out of the loop
+            postloop = builder.append_basic_block(name="postloop")
+
+            builder.position_at_end(preloop)
+            builder.cbranch(is_zero, postloop, body)
+
+            builder.position_at_start(postloop)
+            self.pointer = pointer
+            if caller is not None:
+                self.return_to(caller)
+        elif op == ADD:
+            # a folded run of +/-, already wrapped to the cell size
+            location = self.get_tape_location()
+            value = builder.load(location)
+            new_value = builder.add(value, self.cell_type(amount))
+            builder.store(new_value, location)
+        elif op == MOVE:
+            # a folded run of >/<, no code is needed until the pointer is
+            # used at a loop boundary
+            self.offset += amount
+        elif op == CLEAR:
+            # a [-] style loop, the cell always ends up as zero
+            location = self.get_tape_location()
+            builder.store(self.cell_type(0), location)
+        elif op == SET:
+            # a cell whose new value is known at compile time
+            location = self.get_tape_location(program.offsets[index])
+            builder.store(self.cell_type(amount), location)
+        elif op == MULADD:
+            # one target of a multiply loop, cell[p+k] += c * cell[p]
+            counter = builder.load(self.get_tape_location())
+            target = self.get_tape_location(program.offsets[index])
+
+            value = builder.load(target)
+            product = builder.mul(counter, self.cell_type(amount))
+            builder.store(builder.add(value, product), target)
+        elif op == SCAN:
+            self.compile_scan(amount)
+        elif op == OUTPUT:
+            # print the value at the current tape location
+            self.count_op(index)
+            location = self.get_tape_location()
+            tape_value = builder.load(location)
+            if self.cell_bits > 8:
+                tape_value = builder.trunc(tape_value, byte)
+
+            self.runtime.call(builder, self.runtime.putc, tape_value)
+        elif op == INPUT:
+            #  read a character from stdin and store it at the current tape location
+            self.count_op(index)
+            location = self.get_tape_location()
+
+            char = self.runtime.call(builder, self.runtime.getc)
+            is_eof = builder.icmp_unsigned("==", char, eof)
+
+            with builder.if_else(is_eof) as (then, otherwise):
+                with then:
+                    if self.eof_behavior == "zero":
+                        builder.store(self.cell_type(0), location)
+                    elif self.eof_behavior == "minus_one":
+                        builder.store(self.cell_type(-1), location)
+
+                with otherwise:
+                    char = self.cast_index(char, self.cell_type)
+                    builder.store(char, location)
+
+    def locate(self, position):
+        # the code that follows is for the op at token position
+        if self.debug is not None:
+            self.builder.debug_metadata = self.debug.location(
+                position, self.scope)
+
+    def compile_scan(self, stride):
+        builder = self.builder
+        self.materialize_pointer()
+
+        start_index = self.pointer
+        if stride in (1, -1) and self.cell_bits == 8:
+            # let libc find the zero cell between the pointer and the
+            # end (or start) of the tape
+            offset = self.cast_index(self.pointer, size_t)
+
+            if stride == 1:
+                start = builder.gep(self.tape, (offset,), inbounds=True)
+                length = builder.sub(size_t(self.tape_size), offset)
+                found = builder.call(self.memchr, (start, int32(0), length))
+            else:
+                length = builder.add(offset, size_t(1))
+                found = builder.call(
+                    self.memrchr, (self.tape, int32(0), length))
+
+            is_null = builder.icmp_unsigned(
+                "==", found, ir.Constant(byte.as_pointer(), None))
+
+            prefound = builder.block
+            scanfound = builder.append_basic_block(name="scanfound")
+            prescan = builder.append_basic_block(name="prescan")
+            builder.cbranch(is_null, prescan, scanfound)
+
+            builder.position_at_start(scanfound)
+            distance = builder.sub(
+                builder.ptrtoint(found, size_t), builder.ptrtoint(self.tape, size_t))
+            found_index = self.cast_index(distance, self.index_type)
+            builder.branch(prescan)
+
+            builder.position_at_start(prescan)
+            start_index = builder.phi(self.index_type)
+            start_index.add_incoming(self.pointer, prefound)
+            start_index.add_incoming(found_index, scanfound)
+
+        # step through the tape with the index kept in a register, this
+        # also covers the wraparound the libc search doesn't
+        prescan = builder.block
+        scan = builder.append_basic_block(name="scan")
+        builder.branch(scan)
+        builder.position_at_start(scan)
+
+        scan_index = builder.phi(self.index_type)
+        scan_index.add_incoming(start_index, prescan)
+        self.pointer = scan_index
+
+        is_zero = builder.icmp_unsigned(
+            "==", builder.load(self.get_tape_location()), self.cell_type(0))
+        next_index = builder.add(
+            scan_index, self.index_type(self.wrap(stride)))
+        scan_index.add_incoming(next_index, scan)
+
+        postscan = builder.append_basic_block(name="postscan")
+        builder.cbranch(is_zero, postscan, scan)
+        builder.position_at_start(postscan)
+
 
 def test():
-    code = "+-[]"
+    code = "+-[]++++>>-<"
     lexer = BFLexer()
     code = lexer.lex(code)
 
     parser = BrainfuckParser(code)
     ast = parser.parse_program()
+    ast = ASTOptimizer(ast).optimize()
 
     converter = IRManager(ast)
     result = converter.to_llvm_ir()
@@ -157,5 +825,33 @@ def test():
     print(result)
 
 
+def test_deep_nesting(depth=5000):
+    # every stage has to cope with nesting far past the recursion limit
+    import sys
+    from .semantic_analysis import SemanticAnalysis
+
+    assert depth > sys.getrecursionlimit()
+    code = "+" + "[>+" * depth + "-]" * depth
+    code = BFLexer().lex_fast(code)
+
+    ast = BrainfuckParser(code).parse_program()
+    SemanticAnalysis(ast).analyze()
+    SemanticAnalysis(code).analyze()
+
+    # the loops come out nested, not side by side
+    node, levels = ast, 0
+    while True:
+        loops = [child for child in node.children if child.value == "Loop"]
+        if not loops:
+            break
+        node, levels = loops[0], levels + 1
+    assert levels == depth
+
+    ast = ASTOptimizer(ast).optimize()
+    module = IRManager(ast).to_llvm_ir()
+    llvm.parse_assembly(str(module)).verify()
+
+
 if __name__ == "__main__":
     test()
+    test_deep_nesting()
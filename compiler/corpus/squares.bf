@@ -0,0 +1,4 @@
+prints the squares from 0 to 10000
+by Daniel B Cristofani (cristofd at hevanet dot com)
+from brainfuck dot org
+++++[>+++++<-]>[<+++++>-]+<+[>[>+>+<<-]++>>[<<+>>-]>>>[-]++>[-]+>>>+[[-]++++++>>>]<<<[[<++++++++<++>>-]+<.<[>----<-]<]<<[>>>>>[>>>[-]+++++++++<[>-<-]+++++++++>[-[<->-]+[<<<]]<[>+<-]>]<<-]<<-]
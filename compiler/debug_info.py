@@ -0,0 +1,123 @@
+# dwarf line tables for the generated code, every op gets the line and
+# column of its command in the source file, so debuggers and profilers that
+# read debug info (gdb, perf report --sort srcline, addr2line) point back at
+# the brainfuck source
+# https://llvm.org/docs/SourceLevelDebugging.html
+
+import os
+from array import array
+
+from llvmlite import ir
+
+COMMANDS = frozenset(b"+-<>[].,")
+NEWLINE = ord("\n")
+
+int32 = ir.IntType(32)
+
+
+class DebugInfo:
+    def __init__(self, module: ir.Module, path) -> None:
+        # path is the source file the tokens were lexed from
+        with open(path, "rb") as f:
+            source = f.read()
+
+        # the line and column of each token, as token indices are what the
+        # program keeps for every op
+        self.lines = array("i")
+        self.columns = array("i")
+        line, line_start = 1, 0
+        for index, char in enumerate(source):
+            if char == NEWLINE:
+                line, line_start = line + 1, index + 1
+            elif char in COMMANDS:
+                self.lines.append(line)
+                self.columns.append(index - line_start + 1)
+
+        self.module = module
+        path = os.path.abspath(path)
+        self.file = module.add_debug_info("DIFile", {
+            "filename": os.path.basename(path),
+            "directory": os.path.dirname(path),
+        })
+        self.unit = module.add_debug_info("DICompileUnit", {
+            "language": ir.DIToken("DW_LANG_C"),
+            "file": self.file,
+            "producer": "bfcompiler",
+            "runtimeVersion": 0,
+            "isOptimized": True,
+            "emissionKind": ir.DIToken("LineTablesOnly"),
+        }, is_distinct=True)
+        module.add_named_metadata("llvm.dbg.cu", self.unit)
+        self.function_type = module.add_debug_info("DISubroutineType", {
+            "types": module.add_metadata([]),
+        })
+
+        flags = module.add_named_metadata("llvm.module.flags")
+        for name, version in (("Dwarf Version", 4), ("Debug Info Version", 3)):
+            flags.add(module.add_metadata([int32(2), name, int32(version)]))
+
+    def position(self, token):
+        # (line, column) of a token, the end of the source for ops past it
+        if not self.lines:
+            return 1, 1
+        token = min(token, len(self.lines) - 1)
+        return self.lines[token], self.columns[token]
+
+    def subprogram(self, function: ir.Function, token=0):
+        # the scope for the code of function, which starts at token
+        line = self.position(token)[0]
+        scope = self.module.add_debug_info("DISubprogram", {
+            "name": function.name,
+            "file": self.file,
+            "line": line,
+            "scopeLine": line,
+            "type": self.function_type,
+            "isLocal": function.linkage == "internal",
+            "isDefinition": True,
+            "isOptimized": True,
+            "unit": self.unit,
+        }, is_distinct=True)
+        function.set_metadata("dbg", scope)
+        return scope
+
+    def location(self, token, scope):
+        line, column = self.position(token)
+        return self.module.add_debug_info("DILocation", {
+            "line": line,
+            "column": column,
+            "scope": scope,
+        })
+
+
+def test():
+    import tempfile
+    from llvmlite import binding as llvm
+    from .lexer import BFLexer
+    from .flatprogram import FlatProgram
+    from .code_generation import IRManager
+    from .jit import AOTCompiler
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "program.bf")
+        with open(path, "w") as f:
+            f.write("adds one\n  +[ loops\n-].\n")
+        tokens = BFLexer().lex_file(path)
+        debug = DebugInfo(ir.Module(), path)
+        assert [debug.position(token) for token in range(len(tokens))] == [
+            (2, 3), (2, 4), (3, 1), (3, 2), (3, 3)]
+
+        module = IRManager(
+            FlatProgram.from_tokens(tokens), outline_loops=True, step_budget=0,
+            debug_source=path).to_llvm_ir()
+        llvm.parse_assembly(str(module)).verify()
+        assert "DILocation(column: 3, line: 3" in str(module)
+
+        # and the object code has the line table
+        object_path = os.path.join(directory, "program.o")
+        AOTCompiler(opt_level=2).emit_object(module, object_path)
+        with open(object_path, "rb") as f:
+            assert b".debug_line" in f.read()
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,262 @@
+# a flat representation of the program, parallel arrays of opcodes and their
+# operands with a precomputed jump table for the brackets, so big programs
+# don't need a python object per command
+# https://www.nayuki.io/page/optimizing-brainfuck-compiler
+
+import re
+from array import array
+
+from .cfgparser import BrainfuckParser, BrainFuckNode
+from .lexer import BFLexer
+from .optimizer import CELL_BIT_SIZE
+
+
+ADD = 0
+MOVE = 1
+OUTPUT = 2
+INPUT = 3
+OPEN = 4
+CLOSE = 5
+CLEAR = 6
+MULADD = 7
+SCAN = 8
+SET = 9
+
+# the ast node value for each opcode
+OP_NAMES = ("Add", "Move", ".", ",", "Loop", "LoopEnd", "Clear", "MulAdd", "Scan",
+            "Set")
+
+PLUS, MINUS, RIGHT, LEFT, DOT, COMMA, OPEN_BRACKET = b"+-><.,["
+
+# runs of +/- and >/< are matched in one go when folding
+RUN_PATTERN = re.compile(rb"[+-]+|[<>]+|.")
+
+
+class FlatProgram:
+    def __init__(self, length=0) -> None:
+        self.ops = array("B")
+        # amount of Add/Move/Scan/MulAdd/Set, and the cell offset of MulAdd/Set
+        self.amounts = array("q")
+        self.offsets = array("i")
+        # token index of each op in the source
+        self.positions = array("q")
+        # index of the matching bracket for Loop/LoopEnd, -1 otherwise
+        self.jumps = array("i")
+        # token index of every [ and ] without a match
+        self.unclosed = []
+        self.unopened = []
+        # number of tokens in the source
+        self.length = length
+
+    def __len__(self):
+        return len(self.ops)
+
+    def append(self, op, position, amount=0, offset=0):
+        self.ops.append(op)
+        self.amounts.append(amount)
+        self.offsets.append(offset)
+        self.positions.append(position)
+        self.jumps.append(-1)
+
+    @classmethod
+    def from_tokens(cls, tokens, fold=True, cell_bits=CELL_BIT_SIZE):
+        # build the program straight from the lexer output, with runs of
+        # +/- and >/< folded into Add/Move unless fold is False, Add amounts
+        # wrap at cell_bits
+        if not isinstance(tokens, (bytes, bytearray)):
+            tokens = "".join(tokens).encode("ascii")
+
+        program = cls(len(tokens))
+        opens = []
+
+        if fold:
+            runs = RUN_PATTERN.findall(tokens)
+        else:
+            runs = re.findall(rb".", tokens)
+
+        # this loop runs once per op, so the appends are looked up only once
+        ops = program.ops.append
+        amounts = program.amounts.append
+        positions = program.positions.append
+        pairs = []
+
+        position = 0
+        for text in runs:
+            char = text[0]
+
+            if char == PLUS or char == MINUS:
+                amount = text.count(b"+") - text.count(b"-")
+                amount %= 2 ** cell_bits
+                if amount != 0:
+                    ops(ADD)
+                    amounts(amount)
+                    positions(position)
+            elif char == RIGHT or char == LEFT:
+                amount = text.count(b">") - text.count(b"<")
+                if amount != 0:
+                    ops(MOVE)
+                    amounts(amount)
+                    positions(position)
+            elif char == DOT:
+                ops(OUTPUT)
+                amounts(0)
+                positions(position)
+            elif char == COMMA:
+                ops(INPUT)
+                amounts(0)
+                positions(position)
+            elif char == OPEN_BRACKET:
+                opens.append(len(program.ops))
+                ops(OPEN)
+                amounts(0)
+                positions(position)
+            elif opens:
+                pairs.append((opens.pop(), len(program.ops)))
+                ops(CLOSE)
+                amounts(0)
+                positions(position)
+            else:
+                program.unopened.append(position)
+
+            position += len(text)
+
+        # only MulAdd has an offset and only brackets have jumps, so fill
+        # them in once at the end
+        program.offsets = array("i", [0]) * len(program.ops)
+        program.jumps = array("i", [-1]) * len(program.ops)
+        for start, end in pairs:
+            program.jumps[start] = end
+            program.jumps[end] = start
+
+        program.unclosed.extend(program.positions[i] for i in opens)
+        return program
+
+    @classmethod
+    def from_tree(cls, ast: BrainFuckNode, cell_bits=CELL_BIT_SIZE):
+        # flatten an (optionally optimized) ast, the stack holds the children
+        # left to visit for each open loop along with its start index
+        program = cls()
+        stack = [(iter(ast.children), None, None)]
+
+        while stack:
+            children, start, loop = stack[-1]
+            node = next(children, None)
+
+            if node is None:
+                stack.pop()
+                if loop is not None:
+                    end = loop.char_index
+                    if loop.children and loop.children[-1].value == "LoopEnd":
+                        end = loop.children[-1].char_index
+                    program.append(CLOSE, end)
+                    program.jumps[start] = len(program) - 1
+                    program.jumps[-1] = start
+            elif node.value == "Loop":
+                stack.append((iter(node.children), len(program), node))
+                program.append(OPEN, node.char_index)
+            elif node.value in ("+", "-"):
+                amount = 1 if node.value == "+" else 2 ** cell_bits - 1
+                program.append(ADD, node.char_index, amount)
+            elif node.value in (">", "<"):
+                amount = 1 if node.value == ">" else -1
+                program.append(MOVE, node.char_index, amount)
+            elif node.value in OP_NAMES and node.value != "LoopEnd":
+                op = OP_NAMES.index(node.value)
+                program.append(op, node.char_index, node.amount, node.offset)
+
+        program.length = ast.char_index
+        return program
+
+    def slice(self, start, stop):
+        # the ops from start up to stop as a program of their own, the
+        # brackets in between have to be balanced
+        program = FlatProgram(self.length)
+        program.ops = self.ops[start:stop]
+        program.amounts = self.amounts[start:stop]
+        program.offsets = self.offsets[start:stop]
+        program.positions = self.positions[start:stop]
+        program.jumps = array(
+            "i", (jump - start if jump != -1 else -1 for jump in self.jumps[start:stop]))
+        return program
+
+    @classmethod
+    def join(cls, programs, length=0):
+        # the programs one after another, each with balanced brackets
+        joined = cls(length)
+        for program in programs:
+            base = len(joined)
+            joined.ops.extend(program.ops)
+            joined.amounts.extend(program.amounts)
+            joined.offsets.extend(program.offsets)
+            joined.positions.extend(program.positions)
+            joined.jumps.extend(
+                jump + base if jump != -1 else -1 for jump in program.jumps)
+        return joined
+
+    def node(self, index):
+        # the ast node for a single op
+        op = self.ops[index]
+        return BrainFuckNode(
+            OP_NAMES[op], self.positions[index],
+            amount=self.amounts[index], offset=self.offsets[index])
+
+    def to_tree(self):
+        # materialize the ast, e.g. for visualization
+        root = BrainFuckNode("Program", self.length)
+        stack = [root]
+
+        for index in range(len(self)):
+            node = self.node(index)
+            op = self.ops[index]
+
+            if op == CLOSE:
+                stack[-1].add_child(node)
+                stack.pop()
+            else:
+                stack[-1].add_child(node)
+                if op == OPEN:
+                    stack.append(node)
+
+        return root
+
+
+def test():
+    code = "++++++++[>++++[>++>+++>+++>+<<<<-]>+>+>->>+[<]<-]>>.>---.+++++++..+++.>."
+    lexer = BFLexer()
+    tokens = lexer.lex_fast(code)
+
+    program = FlatProgram.from_tokens(tokens)
+    for index in range(len(program)):
+        print(index, program.node(index), program.jumps[index])
+
+    # the jump table pairs up the brackets
+    assert program.ops[program.jumps[1]] == CLOSE
+    assert program.jumps[program.jumps[1]] == 1
+
+    # unfolded, the tree matches the parser's
+    tree = FlatProgram.from_tokens(tokens, fold=False).to_tree()
+    parsed = BrainfuckParser(lexer.lex(code)).parse_program()
+    expected = [
+        ("Add" if c.value in "+-" else "Move" if c.value in "<>" else c.value)
+        for c in parsed.children]
+    assert [c.value for c in tree.children] == expected
+    assert [c.char_index for c in tree.children] == [
+        c.char_index for c in parsed.children]
+
+    # a loop can be cut out as a program of its own
+    loop = program.slice(1, program.jumps[1] + 1)
+    assert loop.ops[0] == OPEN and loop.jumps[0] == len(loop) - 1
+
+    # and put back together
+    joined = FlatProgram.join([program.slice(0, 1), loop])
+    assert joined.ops.tolist() == program.ops[:len(loop) + 1].tolist()
+    assert joined.jumps[1] == program.jumps[1]
+
+    # unmatched brackets are recorded
+    program = FlatProgram.from_tokens(b"]+[[-]")
+    assert program.unopened == [0]
+    assert program.unclosed == [2]
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,148 @@
+# timings of the stages of the pipeline and counters of what they produced,
+# so latency can be attributed to a stage. the compiler takes an
+# Instrumentation and reports to it, by default it gets DISABLED which does
+# nothing and skips computing the counters
+#
+#   metrics = Instrumentation()
+#   compile(source, instrumentation=metrics)
+#   metrics.to_json()
+
+from contextlib import contextmanager, nullcontext
+import json
+import time
+
+from .flatprogram import FlatProgram
+
+
+class Instrumentation:
+    enabled = True
+
+    def __init__(self, on_start=None, on_end=None, on_count=None) -> None:
+        # on_start(stage) and on_end(stage, seconds) are called around every
+        # stage, on_count(name, value) for every counter
+        self.on_start = on_start
+        self.on_end = on_end
+        self.on_count = on_count
+        # (stage, seconds) in the order they finished, a stage that runs more
+        # than once shows up every time
+        self.stages = []
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        if self.on_start is not None:
+            self.on_start(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.stages.append((name, seconds))
+            if self.on_end is not None:
+                self.on_end(name, seconds)
+
+    def count(self, name, value):
+        self.counters[name] = value
+        if self.on_count is not None:
+            self.on_count(name, value)
+
+    def total(self, name):
+        # the seconds spent in every run of a stage
+        return sum(seconds for stage, seconds in self.stages if stage == name)
+
+    def to_dict(self):
+        return {
+            "stages": [{"stage": stage, "time": seconds}
+                       for stage, seconds in self.stages],
+            "counters": dict(self.counters),
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+
+class DisabledInstrumentation:
+    # the same interface for when nobody is listening, callers check enabled
+    # before computing a counter that costs anything
+    enabled = False
+
+    def stage(self, name):
+        return NO_STAGE
+
+    def count(self, name, value):
+        pass
+
+
+NO_STAGE = nullcontext()
+DISABLED = DisabledInstrumentation()
+
+
+def count_nodes(ast):
+    # the ops in a flat program or the nodes under the root of a tree
+    if isinstance(ast, FlatProgram):
+        return len(ast)
+    count = 0
+    stack = list(ast.children)
+    while stack:
+        node = stack.pop()
+        count += 1
+        stack.extend(node.children)
+    return count
+
+
+def count_ir(module):
+    # (instructions, basic blocks) in the defined functions of an llvmlite
+    # ir module, or a binding module after the llvm passes
+    instructions = blocks = 0
+    for function in module.functions:
+        for block in function.blocks:
+            blocks += 1
+            instructions += sum(1 for _ in block.instructions)
+    return instructions, blocks
+
+
+def count_module(instrumentation, module, prefix=""):
+    # module can also be the list of modules of a split program
+    if instrumentation.enabled:
+        modules = module if isinstance(module, list) else [module]
+        counts = [count_ir(module) for module in modules]
+        instrumentation.count(
+            prefix + "ir_instructions", sum(count[0] for count in counts))
+        instrumentation.count(
+            prefix + "basic_blocks", sum(count[1] for count in counts))
+
+
+def test():
+    from .program import compile
+
+    events = []
+    metrics = Instrumentation(
+        on_start=lambda stage: events.append(("start", stage)),
+        on_end=lambda stage, seconds: events.append(("end", stage)))
+    program = compile(",[.,]", instrumentation=metrics)
+    assert program(b"hi") == b"hi"
+
+    stages = [stage for stage, _ in metrics.stages]
+    assert stages == ["lex", "semantic", "parse", "range", "optimize",
+                      "codegen", "llvm-opt", "jit"], stages
+    assert events[:2] == [("start", "lex"), ("end", "lex")]
+
+    counters = metrics.counters
+    assert counters["tokens"] == 5
+    assert counters["nodes"] == counters["optimized_nodes"] == 5
+    assert counters["ir_instructions"] > counters["basic_blocks"] > 0
+    assert counters["opt_ir_instructions"] > 0
+    assert counters["object_bytes"] > 0
+
+    # round trips through json
+    data = json.loads(metrics.to_json())
+    assert data["counters"] == counters
+    assert [entry["stage"] for entry in data["stages"]] == stages
+
+    # nothing is recorded by default
+    with DISABLED.stage("lex"):
+        DISABLED.count("tokens", 1)
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,228 @@
+# a bytecode interpreter over the flat program, for small programs where
+# starting llvm takes longer than just running them. in tiered mode hot loops
+# get handed to the jit once they have run often enough
+# https://www.nayuki.io/page/optimizing-brainfuck-compiler
+
+import ctypes
+import sys
+
+from .flatprogram import (FlatProgram, ADD, MOVE, OUTPUT, INPUT, OPEN, CLOSE,
+                          CLEAR, MULADD, SCAN, SET)
+from .lexer import BFLexer
+from .optimizer import CELL_BIT_SIZE, INDEX_BIT_SIZE
+
+
+TAPE_SIZE = 2 ** INDEX_BIT_SIZE
+INDEX_MASK = TAPE_SIZE - 1
+CELL_MASK = 2 ** CELL_BIT_SIZE - 1
+
+OUTPUT_BUFFER_SIZE = 2 ** 16
+
+# what , stores once the input runs out, None leaves the cell alone
+EOF_VALUES = {"zero": 0, "minus_one": CELL_MASK, "unchanged": None}
+
+# loop iterations before a loop is compiled in tiered mode
+DEFAULT_JIT_THRESHOLD = 10000
+
+
+class Interpreter:
+    def __init__(self, program: FlatProgram, input_stream=None, output_stream=None,
+                 eof_behavior="zero", jit_threshold=None, opt_level=2,
+                 buffered_io=True) -> None:
+        if eof_behavior not in EOF_VALUES:
+            raise ValueError(
+                "eof_behavior must be one of {}".format(tuple(EOF_VALUES)))
+        self.program = program
+        self.input_stream = input_stream or sys.stdin.buffer
+        self.output_stream = output_stream or sys.stdout.buffer
+        self.eof_value = EOF_VALUES[eof_behavior]
+        # without buffering every . is written out straight away
+        self.buffer_size = OUTPUT_BUFFER_SIZE if buffered_io else 1
+
+        # None interprets everything, otherwise loops that go around this
+        # many times are compiled
+        self.jit_threshold = jit_threshold
+        self.opt_level = opt_level
+        self.jit = None
+        # compiled loops by the index of their [
+        self.native_loops = {}
+
+        self.tape = bytearray(TAPE_SIZE)
+        self.output = bytearray()
+
+    def flush(self):
+        if self.output:
+            self.output_stream.write(self.output)
+            self.output_stream.flush()
+            self.output.clear()
+
+    def read_byte(self):
+        # flush first, the program might be waiting on a prompt it printed
+        self.flush()
+        char = self.input_stream.read(1)
+        if not char:
+            return self.eof_value
+        return char[0]
+
+    def run(self):
+        program = self.program
+        # plain lists index faster than arrays
+        ops = program.ops.tolist()
+        amounts = program.amounts.tolist()
+        offsets = program.offsets.tolist()
+        jumps = program.jumps.tolist()
+
+        tape = self.tape
+        output = self.output
+        buffer_size = self.buffer_size
+        native_loops = self.native_loops
+        tiered = self.jit_threshold is not None
+        counts = [0] * len(ops) if tiered else None
+
+        pointer = 0
+        pc = 0
+        end = len(ops)
+        while pc < end:
+            op = ops[pc]
+
+            if op == ADD:
+                tape[pointer] = (tape[pointer] + amounts[pc]) & CELL_MASK
+            elif op == MOVE:
+                pointer = (pointer + amounts[pc]) & INDEX_MASK
+            elif op == OPEN:
+                if tape[pointer] == 0:
+                    pc = jumps[pc]
+                elif pc in native_loops:
+                    # the compiled loop runs to completion
+                    pointer = native_loops[pc](self.tape_address, pointer)
+                    pc = jumps[pc]
+            elif op == CLOSE:
+                if tape[pointer] != 0:
+                    pc = jumps[pc]
+                    if tiered:
+                        counts[pc] += 1
+                        if counts[pc] == self.jit_threshold and self.promote(pc):
+                            pointer = native_loops[pc](
+                                self.tape_address, pointer)
+                            pc = jumps[pc]
+            elif op == CLEAR:
+                tape[pointer] = 0
+            elif op == SET:
+                tape[(pointer + offsets[pc]) & INDEX_MASK] = amounts[pc]
+            elif op == MULADD:
+                target = (pointer + offsets[pc]) & INDEX_MASK
+                tape[target] = (tape[target] + tape[pointer]
+                                * amounts[pc]) & CELL_MASK
+            elif op == SCAN:
+                stride = amounts[pc]
+                # bytearray can search for the zero cell itself
+                if stride == 1:
+                    found = tape.find(0, pointer)
+                elif stride == -1:
+                    found = tape.rfind(0, 0, pointer + 1)
+                else:
+                    found = -1
+                if found != -1:
+                    pointer = found
+                while tape[pointer] != 0:
+                    pointer = (pointer + stride) & INDEX_MASK
+            elif op == OUTPUT:
+                output.append(tape[pointer])
+                if len(output) >= buffer_size:
+                    self.flush()
+            elif op == INPUT:
+                char = self.read_byte()
+                if char is not None:
+                    tape[pointer] = char
+
+            pc += 1
+
+        self.flush()
+        return 0
+
+    def promote(self, start):
+        # compile the loop starting at start, io stays in the interpreter so
+        # loops that do any are left alone
+        program = self.program
+        stop = program.jumps[start] + 1
+        if any(op in (INPUT, OUTPUT) for op in program.ops[start:stop]):
+            return False
+
+        from .code_generation import IRManager
+        from .jit import JITCompiler
+
+        if self.jit is None:
+            self.jit = JITCompiler(self.opt_level, verbose=False)
+            self.tape_buffer = (ctypes.c_char * TAPE_SIZE).from_buffer(self.tape)
+            self.tape_address = ctypes.addressof(self.tape_buffer)
+
+        # not bf_loop_, the loops outlined from it are named that way
+        name = "bf_tier_{}".format(start)
+        module = IRManager(program.slice(start, stop)
+                           ).to_llvm_function_ir(name)
+        address = self.jit.get_function(module, name)
+
+        function_type = ctypes.CFUNCTYPE(
+            ctypes.c_uint16, ctypes.c_void_p, ctypes.c_uint16)
+        self.native_loops[start] = function_type(address)
+        return True
+
+
+def test():
+    import io
+
+    code = "++++++++[>++++[>++>+++>+++>+<<<<-]>+>+>->>+[<]<-]>>.>---.+++++++..+++.>>.<-.<.+++.------.--------.>>+.>++."
+    program = FlatProgram.from_tokens(BFLexer().lex_fast(code))
+
+    output = io.BytesIO()
+    Interpreter(program, output_stream=output).run()
+    assert output.getvalue() == b"Hello World!\n"
+
+    # input, and eof leaving the cell alone
+    program = FlatProgram.from_tokens(b",.,.,.,.")
+    output = io.BytesIO()
+    Interpreter(program, io.BytesIO(b"ab"), output,
+                eof_behavior="unchanged").run()
+    assert output.getvalue() == b"abbb"
+
+    # unbuffered, every byte is written as soon as it is output
+    class Writes(io.BytesIO):
+        def __init__(self):
+            super().__init__()
+            self.writes = []
+
+        def write(self, data):
+            self.writes.append(bytes(data))
+            return super().write(data)
+
+    output = Writes()
+    Interpreter(FlatProgram.from_tokens(b"+.+.+."), output_stream=output,
+                buffered_io=False).run()
+    assert output.writes == [b"\x01", b"\x02", b"\x03"]
+    output = Writes()
+    Interpreter(FlatProgram.from_tokens(b"+.+.+."), output_stream=output).run()
+    assert output.writes == [b"\x01\x02\x03"]
+
+    # a loop hot enough to be compiled gives the same result
+    code = "+++++[>++++++++[>+++++++<-]<-]>>."
+    program = FlatProgram.from_tokens(BFLexer().lex_fast(code))
+    output = io.BytesIO()
+    interpreter = Interpreter(program, output_stream=output, jit_threshold=2)
+    interpreter.run()
+    assert interpreter.native_loops
+    assert output.getvalue() == bytes([5 * 8 * 7 % 256])
+
+    # a loop big enough to be outlined itself, whose op index is also its
+    # token index
+    from .code_generation import OUTLINE_SIZE
+    code = "+[" + ">+<-" * (OUTLINE_SIZE // 3) + "]>."
+    program = FlatProgram.from_tokens(BFLexer().lex_fast(code))
+    output = io.BytesIO()
+    interpreter = Interpreter(program, output_stream=output, jit_threshold=1)
+    interpreter.run()
+    assert interpreter.native_loops
+    assert output.getvalue() == b"\x01"
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,369 @@
+from llvmlite import binding as llvm
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import os
+import subprocess
+import sys
+import tempfile
+
+from .instrumentation import DISABLED, count_module
+from .perfmap import function_symbols, locate, write_perf_map
+
+
+OPT_LEVELS = (0, 1, 2, 3)
+
+# modules with a function of more basic blocks than these are optimized at
+# -O1 and -O0 at most, llvm takes more than linear time in the size of a
+# function and would otherwise take minutes on huge generated programs
+LARGE_FUNCTION = 2 ** 13
+HUGE_FUNCTION = 2 ** 16
+
+libc = ctypes.CDLL(None)
+
+
+class LLVMCompiler:
+    def __init__(self, opt_level=0, reloc="default",
+                 instrumentation=DISABLED) -> None:
+        if opt_level not in OPT_LEVELS:
+            raise ValueError("opt_level must be one of {}".format(OPT_LEVELS))
+        self.opt_level = opt_level
+        self.instrumentation = instrumentation
+
+        llvm.initialize()
+        llvm.initialize_native_target()
+        llvm.initialize_native_asmprinter()
+        self.target = llvm.Target.from_default_triple()
+        self.reloc = reloc
+
+        # generate code for the cpu we are running on
+        try:
+            features = llvm.get_host_cpu_features().flatten()
+        except RuntimeError:
+            features = ""
+
+        self.cpu = llvm.get_host_cpu_name()
+        self.features = features
+        self.target_machine = self.create_target_machine(opt_level)
+
+    def create_target_machine(self, opt_level):
+        return self.target.create_target_machine(
+            cpu=self.cpu, features=self.features, opt=opt_level,
+            reloc=self.reloc)
+
+    def opt_level_for(self, ir_module):
+        # the opt level for a module, lowered when one of its functions is so
+        # big llvm would take much longer than it's worth
+        largest = max((len(function.blocks) for function in ir_module.functions),
+                      default=0)
+        if largest > HUGE_FUNCTION:
+            return 0
+        if largest > LARGE_FUNCTION:
+            return min(self.opt_level, 1)
+        return self.opt_level
+
+    def optimize(self, ir_module):
+        with self.instrumentation.stage("llvm-opt"):
+            binding_module = self.run_passes(
+                str(ir_module), self.opt_level_for(ir_module))
+        count_module(self.instrumentation, binding_module, "opt_")
+        return binding_module
+
+    def run_passes(self, text, opt_level, context=None, target_machine=None):
+        # parse the module and run the llvm pass pipeline for the opt level
+        target_machine = target_machine or self.target_machine
+        binding_module = llvm.parse_assembly(text, context)
+        binding_module.triple = target_machine.triple
+        binding_module.data_layout = str(target_machine.target_data)
+        binding_module.verify()
+
+        if opt_level > 0:
+            pass_builder = llvm.create_pass_manager_builder()
+            pass_builder.opt_level = opt_level
+
+            pass_manager = llvm.create_module_pass_manager()
+            target_machine.add_analysis_passes(pass_manager)
+            pass_builder.populate(pass_manager)
+            pass_manager.run(binding_module)
+
+        return binding_module
+
+    def emit_objects(self, ir_modules, workers=None):
+        # the object code of each module of a split program, compiled on a
+        # pool of threads. llvm lets go of the gil, and every module gets a
+        # context and target machine of its own as they can't be shared
+        # between threads. only turning the modules into text needs python
+        def emit(module):
+            text, opt_level = module
+            target_machine = self.create_target_machine(opt_level)
+            binding_module = self.run_passes(
+                text, opt_level, llvm.create_context(), target_machine)
+            return target_machine.emit_object(binding_module)
+
+        with self.instrumentation.stage("llvm-opt"):
+            modules = [(str(module), self.opt_level_for(module))
+                       for module in ir_modules]
+            with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+                objects = list(pool.map(emit, modules))
+        self.instrumentation.count(
+            "object_bytes", sum(len(data) for data in objects))
+        return objects
+
+    def dump_ir(self, ir_module):
+        # the llvm ir after optimization, as it will be compiled
+        return str(self.optimize(ir_module))
+
+
+# compiles modules in memory with an mcjit engine and runs main or hands back
+# the address of a function, optionally through the on-disk object cache
+class JITCompiler(LLVMCompiler):
+    def __init__(self, opt_level=0, cache=None, verbose=True,
+                 instrumentation=DISABLED, perf_map=None) -> None:
+        super().__init__(opt_level, instrumentation=instrumentation)
+        # an optional ObjectCache to store compiled programs in
+        self.cache = cache
+        # whether to print around the program output
+        self.verbose = verbose
+        # a file to write the address of every compiled function to, for
+        # perf, usually perfmap.perf_map_path()
+        self.perf_map = perf_map
+        # the object code of the last module, if anything wanted it
+        self.object_code = None
+
+        # And an execution engine with an empty backing module
+        backing_mod = llvm.parse_assembly("")
+        self.engine = llvm.create_mcjit_compiler(
+            backing_mod, self.target_machine)
+
+    def cache_key(self, tokens, **settings):
+        # cache key for a token stream compiled with this jit and any
+        # code generation settings of the caller
+        return self.cache.key(
+            tokens, opt_level=self.opt_level, triple=self.target_machine.triple,
+            cpu=self.cpu, features=self.features, **settings)
+
+    def run(self, ir_module, cache_key=None):
+        binding_module = self.optimize(ir_module)
+
+        with self.engine as engine:
+            self.watch_objects(cache_key)
+            with self.instrumentation.stage("jit"):
+                engine.add_module(binding_module)
+                engine.finalize_object()
+                engine.run_static_constructors()
+            self.map_functions()
+
+            return self.run_main(engine)
+
+    def run_cached(self, cache_key, build_module):
+        # run the cached object code for the key if there is any, otherwise
+        # build_module() is called to generate the ir and the result is cached
+        data = None
+        if self.cache is not None:
+            data = self.cache.load(cache_key)
+
+        if data is None:
+            return self.run(build_module(), cache_key)
+
+        self.count_object(data)
+        self.object_code = data
+        with self.engine as engine:
+            with self.instrumentation.stage("jit"):
+                engine.add_object_file(llvm.ObjectFileRef.from_data(data))
+                engine.finalize_object()
+            self.map_functions()
+
+            return self.run_main(engine)
+
+    def run_modules(self, ir_modules):
+        # run a program split over several modules, see
+        # IRManager.to_llvm_modules
+        if len(ir_modules) == 1:
+            return self.run(ir_modules[0])
+
+        objects = self.emit_objects(ir_modules)
+        with self.engine as engine:
+            self.add_objects(objects)
+            return self.run_main(engine)
+
+    def get_modules_function(self, ir_modules, name):
+        # get_function for a program split over several modules
+        if len(ir_modules) == 1:
+            return self.get_function(ir_modules[0], name)
+
+        self.add_objects(self.emit_objects(ir_modules))
+        return self.engine.get_function_address(name)
+
+    def add_objects(self, objects):
+        # the engine links the calls between them as it loads them
+        with self.instrumentation.stage("jit"):
+            for data in objects:
+                self.engine.add_object_file(llvm.ObjectFileRef.from_data(data))
+            self.engine.finalize_object()
+        for data in objects:
+            self.object_code = data
+            self.map_functions()
+
+    def get_function(self, ir_module, name):
+        # add the module to the engine and return the address of one of its
+        # functions, the engine stays open so this can be called many times
+        return self.load(self.optimize(ir_module), name)
+
+    def load(self, binding_module, name):
+        # the same for a module that has already been optimized
+        self.watch_objects()
+        with self.instrumentation.stage("jit"):
+            self.engine.add_module(binding_module)
+            self.engine.finalize_object()
+        self.map_functions()
+        return self.engine.get_function_address(name)
+
+    def watch_objects(self, cache_key=None):
+        # llvm hands us the object code once it has been emitted, which the
+        # cache, the object size counter and the perf map want
+        caching = self.cache is not None and cache_key is not None
+        if not (caching or self.instrumentation.enabled or self.perf_map):
+            return
+
+        def emitted(module, data):
+            self.count_object(data)
+            self.object_code = data
+            if caching:
+                self.cache.store(cache_key, data)
+        self.engine.set_object_cache(emitted)
+
+    def map_functions(self):
+        # add the functions of the module that was just loaded to the map
+        if self.perf_map is None or self.object_code is None:
+            return
+        functions = locate(function_symbols(self.object_code),
+                           self.engine.get_function_address)
+        write_perf_map(functions, self.perf_map)
+        self.object_code = None
+
+    def count_object(self, data):
+        self.instrumentation.count("object_bytes", len(data))
+
+    def run_main(self, engine):
+        func_ptr = engine.get_function_address("main")
+
+        # create a function pointer to the main function
+        asm_main = ctypes.CFUNCTYPE(ctypes.c_int)(func_ptr)
+
+        if self.verbose:
+            print("running main...")
+
+        # flush python's buffered output so it comes before the program's
+        sys.stdout.flush()
+        with self.instrumentation.stage("run"):
+            out = asm_main()
+            # and the program's stdio buffers before python writes anything
+            libc.fflush(None)
+
+        if self.verbose:
+            print("output code:", out)
+        return out
+
+
+# ahead of time compilation to object files and executables, linked with the
+# system c compiler since the program only needs libc
+class AOTCompiler(LLVMCompiler):
+    def __init__(self, opt_level=0, instrumentation=DISABLED) -> None:
+        # position independent code so the object links into pie executables
+        super().__init__(opt_level, reloc="pic",
+                         instrumentation=instrumentation)
+
+    def emit_ir(self, ir_module, path):
+        with open(path, "w") as f:
+            f.write(self.dump_ir(ir_module))
+
+    def emit_assembly(self, ir_module, path):
+        binding_module = self.optimize(ir_module)
+        with open(path, "w") as f:
+            f.write(self.target_machine.emit_assembly(binding_module))
+
+    def emit_object(self, ir_module, path):
+        binding_module = self.optimize(ir_module)
+        with self.instrumentation.stage("emit"):
+            data = self.target_machine.emit_object(binding_module)
+        self.instrumentation.count("object_bytes", len(data))
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def build_executable(self, ir_module, path):
+        # ir_module can also be the list of modules of a split program, they
+        # are compiled at the same time and linked together
+        with tempfile.TemporaryDirectory() as directory:
+            if not isinstance(ir_module, list):
+                object_path = os.path.join(directory, "program.o")
+                self.emit_object(ir_module, object_path)
+                self.link([object_path], path)
+                return
+
+            object_paths = []
+            for index, data in enumerate(self.emit_objects(ir_module)):
+                object_paths.append(
+                    os.path.join(directory, "program{}.o".format(index)))
+                with open(object_paths[-1], "wb") as f:
+                    f.write(data)
+            self.link(object_paths, path)
+
+    def link(self, object_paths, path):
+        cc = os.environ.get("CC", "cc")
+        subprocess.run([cc, *object_paths, "-o", path], check=True)
+
+
+def test():
+    from .lexer import BFLexer
+    from .cfgparser import BrainfuckParser
+    from .code_generation import IRManager
+    from .cache import ObjectCache
+
+    lexer = BFLexer()
+    code = lexer.lex(
+        "--<-<<+[+[<+>--->->->-<<<]>]<<--.<++++++.<<-..<<.<+.>>.>>.<<<.+++.>>.>>-.<<<+.")
+
+    print(code)
+
+    tree = BrainfuckParser(code).parse_program()
+
+    man = IRManager(tree)
+    ll = man.to_llvm_ir()
+
+    compiler = JITCompiler(opt_level=2)
+    print(compiler.dump_ir(ll))
+    compiler.run(ll)
+
+    # the second run is served from the object cache without any codegen
+    cache = ObjectCache(tempfile.mkdtemp())
+    for _ in range(2):
+        compiler = JITCompiler(opt_level=2, cache=cache)
+        key = compiler.cache_key(code)
+        compiler.run_cached(key, lambda: IRManager(tree).to_llvm_ir())
+
+    # and natively, as a standalone executable
+    with tempfile.TemporaryDirectory() as directory:
+        executable = os.path.join(directory, "program")
+        AOTCompiler(opt_level=2).build_executable(ll, executable)
+        print("native exit code:", subprocess.run([executable]).returncode)
+
+        # a program split into modules is compiled in parallel and linked
+        modules = IRManager(tree, outline_size=4).to_llvm_modules()
+        assert len(modules) > 1
+        status = JITCompiler(opt_level=2, verbose=False).run_modules(modules)
+        modules = IRManager(tree, outline_size=4).to_llvm_modules()
+        AOTCompiler(opt_level=2).build_executable(modules, executable)
+        assert subprocess.run([executable]).returncode == status
+
+        # 256 only fits in a cell wider than 8 bits, the tape is mapped
+        code = "++++++++[>++++++++<-]>[<++++>-]<[[-]>+<]>" + "+" * 48 + "."
+        tree = BrainfuckParser(lexer.lex(code)).parse_program()
+        for cell_bits, expected in ((8, b"0"), (16, b"1"), (32, b"1")):
+            ll = IRManager(tree, cell_bits=cell_bits, tape_bits=24,
+                           range_analysis=False).to_llvm_ir()
+            AOTCompiler(opt_level=2).build_executable(ll, executable)
+            assert subprocess.run(
+                [executable], capture_output=True).stdout == expected
+
+
+if __name__ == "__main__":
+    test()
@@ -1,3 +1,13 @@
+import mmap
+
+
+# every byte that isn't one of the eight commands, for bytes.translate
+BF_COMMANDS = b"><+-.,[]"
+COMMENT_BYTES = bytes(c for c in range(256) if c not in BF_COMMANDS)
+
+LEX_CHUNK_SIZE = 2 ** 20
+
+
 class BFLexDFA:
     def __init__(self):
         self.state = 0
@@ -88,9 +98,39 @@ class BFLexer:
 
         return tokens
 
+    def lex_fast(self, program):
+        # the same tokens as lex() in a single pass over the program, returned
+        # as one byte per token instead of a list of strings
+        if isinstance(program, str):
+            # multi byte characters never contain command bytes
+            program = program.encode("utf-8")
+        return bytes(program).translate(None, COMMENT_BYTES)
+
+    def lex_chunks(self, source, chunk_size=LEX_CHUNK_SIZE):
+        # lex a file object (or mmap) a chunk at a time
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield self.lex_fast(chunk)
+
+    def lex_file(self, path, chunk_size=LEX_CHUNK_SIZE):
+        # lex a whole file through mmap, so it is never read in all at once
+        with open(path, "rb") as f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files can't be mapped
+                return b""
+
+            with mapped:
+                return b"".join(self.lex_chunks(mapped, chunk_size))
+
 
 # tests
 def test_lexer():
+    import io
+
     lexer = BFLexer()
     tokens = lexer.lex(">+<")
     assert tokens == [">", "+", "<"]
@@ -104,6 +144,13 @@ def test_lexer():
     tokens = lexer.lex(">>+<A[]")
     assert tokens == [">", ">", "+", "<", "[", "]"]
 
+    # the fast lexer finds the same tokens
+    tokens = lexer.lex_fast(">>+<A[]# é,.")
+    assert tokens == b">>+<[],."
+
+    tokens = b"".join(lexer.lex_chunks(io.BytesIO(b"+a-b" * 10), 3))
+    assert tokens == b"+-" * 10
+
 
 if __name__ == "__main__":
     test_lexer()
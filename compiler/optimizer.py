@@ -0,0 +1,315 @@
+# optimization passes over the ast, run between the parser and the code generator
+# https://www.nayuki.io/page/optimizing-brainfuck-compiler
+# https://calmerthanyouare.org/2015/01/07/optimizing-brainfuck.html
+
+from .cfgparser import BrainfuckParser, BrainFuckNode
+from .lexer import BFLexer
+
+
+CELL_BIT_SIZE = 8
+INDEX_BIT_SIZE = 16
+
+
+class ASTOptimizer:
+    def __init__(self, ast, cell_bits=CELL_BIT_SIZE) -> None:
+        self.ast: BrainFuckNode = ast
+        # amounts are wrapped to the cell width the program is compiled for
+        self.cell_size = 2 ** cell_bits
+        # nodes deleted by propagate_constants
+        self.removed = 0
+
+    def optimize(self):
+        # the passes build a new tree, so the original ast is left untouched
+        ast = self.fold_runs(self.ast)
+        ast = self.lower_idioms(ast)
+        ast = self.propagate_constants(ast)
+        return ast
+
+    def rebuild(self, node: BrainFuckNode, add_child, leave_loop=None):
+        # copy the tree under node, add_child(parent, child) adds whatever
+        # child turns into to the new parent, and returns the new loop node
+        # when the child is a loop whose children should be visited as well,
+        # leave_loop(loop) is called once all of them have been.
+        # the walk uses a stack so deep nesting can't hit the recursion limit
+        root = BrainFuckNode(node.value, node.char_index, amount=node.amount)
+        stack = [(root, iter(node.children))]
+
+        while stack:
+            parent, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                if stack and leave_loop is not None:
+                    leave_loop(parent)
+                continue
+
+            loop = add_child(parent, child)
+            if loop is not None:
+                stack.append((loop, iter(child.children)))
+
+        return root
+
+    def copy_loop(self, parent: BrainFuckNode, loop: BrainFuckNode):
+        copy = BrainFuckNode(loop.value, loop.char_index)
+        parent.add_child(copy)
+        return copy
+
+    def fold_runs(self, node: BrainFuckNode):
+        # fold runs of +- into Add(n) and runs of >< into Move(n)
+        def add_child(folded: BrainFuckNode, child: BrainFuckNode):
+            if child.value in ("+", "-", "Add"):
+                kind = "Add"
+            elif child.value in (">", "<", "Move"):
+                kind = "Move"
+            else:
+                kind = None
+
+            if kind is None:
+                if child.value == "Loop":
+                    return self.copy_loop(folded, child)
+                folded.add_child(child)
+                return None
+
+            if child.value in ("+", ">"):
+                amount = 1
+            elif child.value in ("-", "<"):
+                amount = -1
+            else:
+                amount = child.amount
+
+            last = folded.children[-1] if folded.children else None
+            if last is not None and last.value == kind:
+                # merge into the previous run
+                amount += last.amount
+                folded.children.pop()
+                char_index = last.char_index
+            else:
+                char_index = child.char_index
+
+            if kind == "Add":
+                # cells are unsigned and wrap around
+                amount %= self.cell_size
+
+            # runs that cancel out, like +- or ><, are dropped entirely
+            if amount != 0:
+                folded.add_child(BrainFuckNode(kind, char_index, amount=amount))
+            return None
+
+        return self.rebuild(node, add_child)
+
+    def lower_idioms(self, node: BrainFuckNode):
+        # replace clear loops like [-] and copy/multiply loops like [->++>+++<<]
+        # with straight-line Clear and MulAdd nodes, and scan loops like [>>]
+        # with a Scan node, must run after fold_runs
+        def add_child(lowered: BrainFuckNode, child: BrainFuckNode):
+            if child.value != "Loop":
+                lowered.add_child(child)
+                return None
+
+            body = [c for c in child.children if c.value != "LoopEnd"]
+            if len(body) == 1 and body[0].value == "Move":
+                # a search for the next zero cell in steps of the move
+                lowered.add_child(BrainFuckNode(
+                    "Scan", child.char_index, amount=body[0].amount))
+                return None
+
+            deltas = self.match_multiply_loop(child)
+            if deltas is None:
+                return self.copy_loop(lowered, child)
+
+            # the loop runs cell[p] times if the counter is decremented, and
+            # -cell[p] times (mod the cell size) if it is incremented
+            counter = deltas.pop(0)
+            sign = 1 if counter == self.cell_size - 1 else -1
+            for offset, delta in deltas.items():
+                factor = (sign * delta) % self.cell_size
+                lowered.add_child(BrainFuckNode(
+                    "MulAdd", child.char_index, amount=factor, offset=offset))
+
+            lowered.add_child(BrainFuckNode("Clear", child.char_index))
+            return None
+
+        return self.rebuild(node, add_child)
+
+    def propagate_constants(self, node: BrainFuckNode):
+        # track the cells whose values are known, starting from the all zero
+        # tape. loops over a cell known to be zero never run and are deleted,
+        # and adds to a known cell become stores of the result, must run after
+        # lower_idioms
+        # known cell values by position, None for a cell known to be unknown,
+        # cells not in there are zero until the pointer is lost track of
+        state = {"known": {}, "default": 0, "position": 0}
+
+        def value(offset=0):
+            position = state["position"] + offset
+            return state["known"].get(position, state["default"])
+
+        def store(offset, new_value):
+            state["known"][state["position"] + offset] = new_value
+
+        def forget(position):
+            # after a loop or a scan, all we know is the pointer is on a zero
+            state.update(known={position: 0}, default=None, position=position)
+
+        def remove(child: BrainFuckNode):
+            # count the node and everything under it
+            stack = [child]
+            while stack:
+                self.removed += 1
+                stack.extend(stack.pop().children)
+
+        def add_child(folded: BrainFuckNode, child: BrainFuckNode):
+            kind = child.value
+            current = value()
+
+            if kind in ("Loop", "Scan") and current == 0:
+                remove(child)
+                return None
+
+            if kind == "Loop":
+                # the body runs with a nonzero cell, and from the second
+                # iteration on with whatever the last one left behind
+                state.update(known={}, default=None)
+                return self.copy_loop(folded, child)
+            elif kind == "Scan":
+                folded.add_child(child)
+                forget(state["position"])
+            elif kind == "Move":
+                folded.add_child(child)
+                state["position"] += child.amount
+            elif kind == "Add" and current is not None:
+                new_value = (current + child.amount) % self.cell_size
+                folded.add_child(BrainFuckNode(
+                    "Set", child.char_index, amount=new_value))
+                store(0, new_value)
+            elif kind in ("Clear", "Set"):
+                new_value = child.amount if kind == "Set" else 0
+                if value(child.offset) == new_value:
+                    remove(child)
+                    return None
+                folded.add_child(child)
+                store(child.offset, new_value)
+            elif kind == "MulAdd":
+                if current == 0:
+                    remove(child)
+                    return None
+                target = value(child.offset)
+                if current is not None and target is not None:
+                    # both cells are known, so the result is as well
+                    new_value = (target + current * child.amount) % self.cell_size
+                    folded.add_child(BrainFuckNode(
+                        "Set", child.char_index, amount=new_value,
+                        offset=child.offset))
+                    store(child.offset, new_value)
+                else:
+                    folded.add_child(child)
+                    store(child.offset, None)
+            else:
+                # adds to unknown cells and input leave the cell unknown
+                folded.add_child(child)
+                if kind in ("Add", ",", "+", "-"):
+                    store(0, None)
+                elif kind in (">", "<"):
+                    state["position"] += 1 if kind == ">" else -1
+
+            return None
+
+        def leave_loop(loop: BrainFuckNode):
+            # loops only exit on a zero cell
+            forget(state["position"])
+
+        return self.rebuild(node, add_child, leave_loop)
+
+    def match_multiply_loop(self, loop: BrainFuckNode):
+        # returns the cell deltas of a loop body relative to the loop pointer,
+        # or None if the loop is not a balanced multiply loop
+        deltas = {}
+        position = 0
+        for child in loop.children:
+            if child.value == "Add":
+                delta = deltas.get(position, 0) + child.amount
+                deltas[position] = delta % self.cell_size
+            elif child.value == "Move":
+                position += child.amount
+            elif child.value != "LoopEnd":
+                # io, nested loops and anything else we can't reason about
+                return None
+
+        # the pointer has to end up where it started
+        if position != 0:
+            return None
+
+        # and the counter cell has to step by exactly one each iteration
+        if deltas.get(0) not in (1, self.cell_size - 1):
+            return None
+
+        return {offset: delta for offset, delta in deltas.items() if delta != 0}
+
+
+def test():
+    code = "++++++++[>++++[>++>+++>+++>+<<<<-]>+>+>->>+[<]<-]>>.>---.+++++++..+++.>+-<>."
+    lexer = BFLexer()
+    code = lexer.lex(code)
+
+    parser = BrainfuckParser(code)
+    ast = parser.parse_program()
+
+    optimized = ASTOptimizer(ast).optimize()
+
+    def print_tree(node, level=0):
+        print("  " * level + str(node))
+        for child in node.children:
+            print_tree(child, level + 1)
+
+    print_tree(optimized)
+
+    # the tests read input first so the cells aren't known to be zero
+
+    # runs that cancel out leave nothing behind
+    ast = BrainfuckParser(lexer.lex(",+-><+><+")).parse_program()
+    optimized = ASTOptimizer(ast).optimize()
+    assert [(n.value, n.amount) for n in optimized.children] == [
+        (",", 0), ("Add", 2)]
+
+    # cells wrap around at 8 bits
+    ast = BrainfuckParser(lexer.lex("," + "-" * 3)).parse_program()
+    optimized = ASTOptimizer(ast).optimize()
+    assert [(n.value, n.amount) for n in optimized.children] == [
+        (",", 0), ("Add", 253)]
+
+    # or at the width they are compiled for
+    optimized = ASTOptimizer(ast, cell_bits=16).optimize()
+    assert [(n.value, n.amount) for n in optimized.children] == [
+        (",", 0), ("Add", 65533)]
+
+    # clear and multiply loops become straight-line code
+    ast = BrainfuckParser(lexer.lex(",[-]>,[->++>+++<<]")).parse_program()
+    optimized = ASTOptimizer(ast).optimize()
+    assert [str(n) for n in optimized.children] == [
+        ",", "Clear", "Move(1)", ",", "MulAdd(1, 2)", "MulAdd(2, 3)", "Clear"]
+
+    # pointer searches become scans
+    ast = BrainfuckParser(lexer.lex(",[<],[>>>]")).parse_program()
+    optimized = ASTOptimizer(ast).optimize()
+    assert [str(n) for n in optimized.children] == [
+        ",", "Scan(-1)", ",", "Scan(3)"]
+
+    # loops over cells known to be zero are dead: at the start, right after
+    # another loop, and after a clear
+    ast = BrainfuckParser(lexer.lex("[.>]+[.,][<]>,[-][.]")).parse_program()
+    optimizer = ASTOptimizer(ast)
+    optimized = optimizer.optimize()
+    assert [str(n) for n in optimized.children] == [
+        "Set(0, 1)", "Loop", "Move(1)", ",", "Clear"]
+    assert optimizer.removed == 8
+
+    # known values turn into stores of the result
+    ast = BrainfuckParser(lexer.lex("++>+++[-<++>]<-.")).parse_program()
+    optimized = ASTOptimizer(ast).optimize()
+    assert [str(n) for n in optimized.children] == [
+        "Set(0, 2)", "Move(1)", "Set(0, 3)", "Set(-1, 8)", "Clear", "Move(-1)",
+        "Set(0, 7)", "."]
+
+
+if __name__ == "__main__":
+    test()
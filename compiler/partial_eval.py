@@ -0,0 +1,211 @@
+# partial evaluation of the program at compile time. everything up to the
+# first , doesn't depend on the input, so it's run here on a concrete tape and
+# only its output and the tape it leaves behind end up in the compiled program
+# https://en.wikipedia.org/wiki/Partial_evaluation
+
+from .flatprogram import (FlatProgram, ADD, MOVE, OUTPUT, INPUT, OPEN, CLOSE,
+                          CLEAR, MULADD, SCAN, SET)
+from .lexer import BFLexer
+from .optimizer import CELL_BIT_SIZE, INDEX_BIT_SIZE
+
+
+# ops run at compile time before giving up on the rest of the program
+DEFAULT_STEP_BUDGET = 10 ** 5
+
+
+class PartialEvaluator:
+    def __init__(self, program: FlatProgram, step_budget=DEFAULT_STEP_BUDGET,
+                 cell_bits=CELL_BIT_SIZE, tape_size=2 ** INDEX_BIT_SIZE,
+                 wraps=True) -> None:
+        self.program = program
+        self.step_budget = step_budget
+        self.cell_mask = 2 ** cell_bits - 1
+        self.tape_size = tape_size
+        # whether the pointer wraps around the tape, otherwise the evaluation
+        # stops before touching a cell off the tape and leaves the fault to
+        # the compiled program
+        self.wraps = wraps
+
+        # the nonzero cells by index, so big tapes cost nothing
+        self.tape = {}
+        self.pointer = 0
+        # the op the compiled program carries on from
+        self.pc = 0
+        self.output = bytearray()
+
+    def run(self):
+        program = self.program
+        ops = program.ops.tolist()
+        amounts = program.amounts.tolist()
+        offsets = program.offsets.tolist()
+        jumps = program.jumps.tolist()
+
+        tape = self.tape
+        output = self.output
+        cell_mask = self.cell_mask
+        tape_size = self.tape_size
+        index_mask = tape_size - 1 if self.wraps else -1
+
+        pointer = self.pointer
+        pc = self.pc
+        end = len(ops)
+        steps = self.step_budget
+
+        # the state at the last loop entered outside of any other loop. if
+        # the evaluation stops deep in a nest, every enclosing loop is copied
+        # into the residual, so it may be cheaper to carry on from here
+        top_level = self.top_level_loops()
+        checkpoint = (pc, pointer, dict(tape), len(output))
+
+        while pc < end and steps > 0:
+            op = ops[pc]
+            steps -= 1
+
+            if op == OPEN and pc in top_level:
+                checkpoint = (pc, pointer, dict(tape), len(output))
+                steps -= len(tape)
+
+            if op == MOVE:
+                pointer = (pointer + amounts[pc]) & index_mask
+                pc += 1
+                continue
+            if op == INPUT or not 0 <= pointer < tape_size:
+                break
+
+            if op == ADD:
+                tape[pointer] = (tape.get(pointer, 0) + amounts[pc]) & cell_mask
+            elif op == OPEN:
+                if not tape.get(pointer, 0):
+                    pc = jumps[pc]
+            elif op == CLOSE:
+                if tape.get(pointer, 0):
+                    pc = jumps[pc]
+            elif op == CLEAR:
+                tape[pointer] = 0
+            elif op == MULADD or op == SET:
+                target = (pointer + offsets[pc]) & index_mask
+                if not 0 <= target < tape_size:
+                    break
+                if op == SET:
+                    value = amounts[pc]
+                else:
+                    value = tape.get(target, 0) + tape.get(pointer, 0) * amounts[pc]
+                tape[target] = value & cell_mask
+            elif op == SCAN:
+                stride = amounts[pc]
+                while tape.get(pointer, 0) and steps > 0:
+                    pointer = (pointer + stride) & index_mask
+                    steps -= 1
+                    if not 0 <= pointer < tape_size:
+                        break
+                if tape.get(pointer, 0) or not 0 <= pointer < tape_size:
+                    # stopped part way, the scan carries on from here
+                    continue
+            elif op == OUTPUT:
+                output.append(tape.get(pointer, 0) & 0xFF)
+
+            pc += 1
+
+        self.pointer = pointer
+        self.pc = pc
+        if self.residual_size() > 2 * len(program):
+            pc, self.pointer, self.tape, length = checkpoint
+            self.pc = pc
+            del output[length:]
+            tape = self.tape
+
+        for index in [index for index, value in tape.items() if value == 0]:
+            del tape[index]
+        return self
+
+    def is_complete(self):
+        # whether the whole program ran
+        return self.pc >= len(self.program)
+
+    def top_level_loops(self):
+        # the index of every [ that isn't inside another loop
+        ops = self.program.ops
+        jumps = self.program.jumps
+        loops = set()
+        index = 0
+        while index < len(ops):
+            if ops[index] == OPEN:
+                loops.add(index)
+                index = jumps[index]
+            index += 1
+        return loops
+
+    def enclosing_loops(self):
+        # the loops around pc, innermost first
+        ops = self.program.ops
+        jumps = self.program.jumps
+        pc = self.pc
+        return [start for start in range(pc - 1, -1, -1)
+                if ops[start] == OPEN and jumps[start] >= pc]
+
+    def residual_size(self):
+        # the length of the residual, without building it
+        pc = self.pc
+        size = 0
+        for start in self.enclosing_loops():
+            end = self.program.jumps[start]
+            size += (end - pc) + (end + 1 - start)
+            pc = end + 1
+        return size + len(self.program) - pc
+
+    def residual(self):
+        # the rest of the program from pc. if pc is inside loops, each one is
+        # finished off by the rest of its body followed by the whole loop
+        # again, which is what its ] jumping back amounts to
+        program = self.program
+        pc = self.pc
+        jumps = program.jumps
+
+        pieces = []
+        for start in self.enclosing_loops():
+            end = jumps[start]
+            pieces.append(program.slice(pc, end))
+            pieces.append(program.slice(start, end + 1))
+            pc = end + 1
+        pieces.append(program.slice(pc, len(program)))
+
+        return FlatProgram.join(pieces, program.length)
+
+
+def test():
+    lexer = BFLexer()
+
+    # a program without input runs entirely at compile time
+    code = "++++++++[>++++[>++>+++>+++>+<<<<-]>+>+>->>+[<]<-]>>.>---.+++++++..+++.>>.<-.<.+++.------.--------.>>+.>++."
+    evaluator = PartialEvaluator(FlatProgram.from_tokens(lexer.lex_fast(code)))
+    evaluator.run()
+    assert evaluator.is_complete()
+    assert evaluator.output == b"Hello World!\n"
+    assert len(evaluator.residual()) == 0
+
+    # input stops the evaluation, the tape is kept for the rest
+    program = FlatProgram.from_tokens(lexer.lex_fast("+++>++.<,."))
+    evaluator = PartialEvaluator(program).run()
+    assert evaluator.tape == {0: 3, 1: 2} and evaluator.pointer == 0
+    assert evaluator.output == b"\x02"
+    assert [str(program.node(i)) for i in range(evaluator.pc, len(program))] == [
+        ",", "."]
+
+    # running out of steps inside a loop finishes the loop in the residual
+    program = FlatProgram.from_tokens(lexer.lex_fast("++++[>+<-]>."))
+    evaluator = PartialEvaluator(program, step_budget=7).run()
+    residual = evaluator.residual()
+    assert not evaluator.is_complete()
+    assert residual.ops[residual.jumps[-3]] == OPEN
+    assert residual.jumps[residual.jumps[-3]] == len(residual) - 3
+
+    # but stopping deep in a nest goes back to the start of the outer loop
+    # rather than copying every loop around it
+    program = FlatProgram.from_tokens(lexer.lex_fast("+" + "[" * 50 + "-" + "]" * 50))
+    evaluator = PartialEvaluator(program, step_budget=40).run()
+    assert evaluator.pc == 1 and evaluator.tape == {0: 1}
+    assert len(evaluator.residual()) == len(program) - 1
+
+
+if __name__ == "__main__":
+    test()
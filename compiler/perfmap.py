@@ -0,0 +1,100 @@
+# symbols for jit compiled code, so linux perf can name the functions it
+# samples instead of showing bare addresses. perf looks for a map of
+# "start size name" lines in /tmp/perf-<pid>.map for code it can't find in
+# a mapped file
+# https://github.com/torvalds/linux/blob/master/tools/perf/Documentation/jit-interface.txt
+
+import os
+import struct
+
+ELF_MAGIC = b"\x7fELF"
+SECTION_HEADER = struct.Struct("<IIQQQQIIQQ")
+SYMBOL = struct.Struct("<IBBHQQ")
+SHT_SYMTAB = 2
+STT_FUNC = 2
+STB_GLOBAL = 1
+
+
+def perf_map_path(pid=None):
+    return "/tmp/perf-{}.map".format(os.getpid() if pid is None else pid)
+
+
+def function_symbols(data):
+    # (name, section index, offset in the section, size, is global) of every
+    # function in a little endian elf64 object file
+    data = bytes(data)
+    if data[:4] != ELF_MAGIC or data[4] != 2 or data[5] != 1:
+        raise ValueError("not a little endian 64 bit elf object")
+
+    offset, = struct.unpack_from("<Q", data, 0x28)
+    entry_size, count = struct.unpack_from("<HH", data, 0x3A)
+    sections = [SECTION_HEADER.unpack_from(data, offset + index * entry_size)
+                for index in range(count)]
+
+    symbols = []
+    for _, kind, _, _, start, size, link, _, _, symbol_size in sections:
+        if kind != SHT_SYMTAB:
+            continue
+        names = sections[link][4]
+        for position in range(start, start + size, symbol_size):
+            name, info, _, section, value, length = SYMBOL.unpack_from(
+                data, position)
+            if info & 0xf != STT_FUNC or length == 0:
+                continue
+            end = data.index(b"\0", names + name)
+            symbols.append((data[names + name:end].decode(), section, value,
+                            length, info >> 4 == STB_GLOBAL))
+    return symbols
+
+
+def locate(symbols, address_of):
+    # [(address, size, name)] of the functions once the object is loaded,
+    # address_of(name) is where a global function ended up, and every other
+    # function moved along with the section it is in
+    bases = {}
+    for name, section, value, _, is_global in symbols:
+        if is_global and section not in bases:
+            address = address_of(name)
+            if address:
+                bases[section] = address - value
+    return [(bases[section] + value, size, name)
+            for name, section, value, size, _ in symbols if section in bases]
+
+
+def write_perf_map(functions, path=None):
+    # added to the end, every module the process compiles has its own lines
+    with open(path or perf_map_path(), "a") as f:
+        for address, size, name in sorted(functions):
+            f.write("{:x} {:x} {}\n".format(address, size, name))
+
+
+def test():
+    import tempfile
+    from .lexer import BFLexer
+    from .flatprogram import FlatProgram
+    from .code_generation import IRManager
+    from .jit import JITCompiler
+
+    tokens = BFLexer().lex_fast("+++[>++[>+<-]<-]>>.")
+    program = FlatProgram.from_tokens(tokens)
+    module = IRManager(program, outline_loops=True, step_budget=0).to_llvm_ir()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "perf.map")
+        jit = JITCompiler(opt_level=2, verbose=False, perf_map=path)
+        main = jit.get_function(module, "main")
+        with open(path) as f:
+            lines = [line.split(" ", 2) for line in f.read().splitlines()]
+
+    names = [name for _, _, name in lines]
+    assert {"main", "bf_loop_3", "bf_loop_7"} <= set(names), names
+
+    # the functions are where the engine put them, and don't overlap
+    assert int(lines[names.index("main")][0], 16) == main
+    spans = [(int(start, 16), int(size, 16)) for start, size, _ in lines]
+    for (start, size), (next_start, _) in zip(spans, spans[1:]):
+        assert 0 < size and start + size <= next_start
+
+
+if __name__ == "__main__":
+    test()
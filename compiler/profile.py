@@ -0,0 +1,122 @@
+# reports on the counts a program compiled with a profile writes when it
+# ends, which loops ran the most and what their code is
+# usage: python -m compiler.profile program.bf profile.txt [--top N]
+
+import argparse
+import sys
+
+from .lexer import BFLexer
+
+# how much of a loop's code is shown
+SNIPPET_WIDTH = 48
+
+
+def read_profile(path):
+    # [(kind, token index, count)] with kind one of "[", "." and ","
+    counts = []
+    with open(path) as f:
+        for line in f:
+            kind, position, count = line.split()
+            counts.append((kind, int(position), int(count)))
+    return counts
+
+
+def snippet(tokens, position, width=SNIPPET_WIDTH):
+    # the code of the loop at position, cut short if it's longer than width
+    depth = 0
+    for end in range(position, min(len(tokens), position + width)):
+        if tokens[end] == "[":
+            depth += 1
+        elif tokens[end] == "]":
+            depth -= 1
+            if depth == 0:
+                return tokens[position:end + 1]
+    return tokens[position:position + width] + "..."
+
+
+def report(counts, tokens, top=10):
+    # the hottest loops by iterations with their share of all iterations,
+    # then the totals of . and ,. tokens is the lexer output the token
+    # indices refer to
+    if isinstance(tokens, (bytes, bytearray)):
+        tokens = tokens.decode("ascii")
+
+    loops = sorted(((count, position) for kind, position, count in counts
+                    if kind == "[" and count), reverse=True)
+    iterations = sum(count for count, _ in loops)
+
+    lines = ["{} loops ran {} iterations".format(len(loops), iterations)]
+    if loops:
+        lines.append("{:>14} {:>6} {:>8}  code".format(
+            "iterations", "share", "index"))
+    for count, position in loops[:top]:
+        lines.append("{:>14} {:>5.1f}% {:>8}  {}".format(
+            count, 100 * count / iterations, position,
+            snippet(tokens, position)))
+
+    for kind, name in ((".", "output"), (",", "input")):
+        sites = [count for site_kind, _, count in counts if site_kind == kind]
+        lines.append("{} {} bytes from {} of {} sites".format(
+            name, sum(sites), sum(1 for count in sites if count), len(sites)))
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m compiler.profile",
+        description="report on the loop counts of a profiled run")
+    parser.add_argument("source", help="the program that was profiled")
+    parser.add_argument("profile", help="the counts it wrote, see --profile")
+    parser.add_argument(
+        "--top", type=int, default=10,
+        help="number of loops to show (default 10)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    tokens = BFLexer().lex_file(args.source)
+    print(report(read_profile(args.profile), tokens, args.top))
+    return 0
+
+
+def test():
+    import os
+    import tempfile
+    from .flatprogram import FlatProgram
+    from .optimizer import ASTOptimizer
+    from .code_generation import IRManager
+    from .jit import JITCompiler
+
+    # the inner loop runs 3 times for each of the 4 outer iterations
+    code = "++++[>+++[>+<-]<-]>>."
+    tokens = BFLexer().lex_fast(code)
+    program = FlatProgram.from_tokens(tokens)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "profile.txt")
+        module = IRManager(program, profile=path).to_llvm_ir()
+        JITCompiler(opt_level=2, verbose=False).run(module)
+        counts = read_profile(path)
+
+        # once optimized the inner loop is a multiply and not a loop anymore
+        ast = ASTOptimizer(program.to_tree()).optimize()
+        JITCompiler(opt_level=2, verbose=False).run(
+            IRManager(ast, profile=path).to_llvm_ir())
+        assert read_profile(path) == [("[", 4, 4), (".", 20, 1)]
+
+    assert counts == [("[", 4, 4), ("[", 9, 12), (".", 20, 1)], counts
+
+    text = report(counts, tokens)
+    lines = text.splitlines()
+    assert lines[0] == "2 loops ran 16 iterations"
+    assert lines[2].split() == ["12", "75.0%", "9", "[>+<-]"]
+    assert lines[3].split() == ["4", "25.0%", "4", "[>+++[>+<-]<-]"]
+    assert lines[-2:] == ["output 1 bytes from 1 of 1 sites",
+                          "input 0 bytes from 0 of 0 sites"]
+
+    assert snippet("[" * 100, 0, 4) == "[[[[..."
+
+
+if __name__ == "__main__":
+    sys.exit(main())
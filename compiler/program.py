@@ -0,0 +1,178 @@
+# the compiler as a library: compile a program once and run the native code
+# as many times as needed on in-memory input, without touching stdin/stdout
+#
+#   program = compile(",[.,]")
+#   program(b"hello") == b"hello"
+
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import os
+
+from .lexer import BFLexer
+from .flatprogram import FlatProgram
+from .semantic_analysis import SemanticAnalysis
+from .range_analysis import PointerRangeAnalysis
+from .optimizer import ASTOptimizer, CELL_BIT_SIZE, INDEX_BIT_SIZE
+from .code_generation import IRManager, OUTLINE_SIZE
+from .partial_eval import DEFAULT_STEP_BUDGET
+from .jit import JITCompiler, libc
+from .instrumentation import DISABLED, count_nodes, count_module
+
+
+# the runtime's io state, see io_state_type
+class IOState(ctypes.Structure):
+    _fields_ = [
+        ("input", ctypes.c_char_p),
+        ("input_length", ctypes.c_uint64),
+        ("input_position", ctypes.c_uint64),
+        ("output", ctypes.c_void_p),
+        ("output_length", ctypes.c_uint64),
+        ("output_capacity", ctypes.c_uint64),
+    ]
+
+
+# int bf_call(IOState *io), ctypes lets go of the gil for the whole call
+CALL_FUNCTION = ctypes.CFUNCTYPE(ctypes.c_int32, ctypes.POINTER(IOState))
+
+
+class CompileError(ValueError):
+    def __init__(self, issues) -> None:
+        super().__init__("; ".join("{} at index {}".format(
+            issue.value, issue.node.char_index) for issue in issues))
+        self.issues = issues
+
+
+def check_program(tokens, tape_bits=INDEX_BIT_SIZE, cell_bits=CELL_BIT_SIZE,
+                  instrumentation=DISABLED):
+    # the issues with the tokens and their flat program, the pointer ranges
+    # are only checked once the brackets match
+    with instrumentation.stage("semantic"):
+        analysis = SemanticAnalysis(tokens)
+        analysis.analyze()
+    issues = analysis.issues
+
+    with instrumentation.stage("parse"):
+        program = FlatProgram.from_tokens(tokens, cell_bits=cell_bits)
+    instrumentation.count("nodes", len(program))
+    if not any(issue.type == "error" for issue in issues):
+        with instrumentation.stage("range"):
+            ranges = PointerRangeAnalysis(program, 2 ** tape_bits)
+            ranges.analyze()
+        issues = issues + ranges.issues
+    return program, issues
+
+
+class Program:
+    def __init__(self, jit, address) -> None:
+        # the jit owns the machine code, so it has to live as long as we do
+        self.jit = jit
+        self.function = CALL_FUNCTION(address)
+
+    def __call__(self, input=b""):
+        # run the program on input and return everything it wrote, calls
+        # share nothing so any number of threads can do this at once
+        input = bytes(input)
+        state = IOState(input, len(input))
+        try:
+            status = self.function(ctypes.byref(state))
+            if status != 0:
+                raise MemoryError("could not allocate the tape")
+            if state.output_length > state.output_capacity:
+                raise MemoryError("could not grow the output buffer")
+            if state.output_length == 0:
+                return b""
+            # not string_at, which takes the length as a c int and fails on
+            # anything over 2 GiB
+            output = ctypes.c_char * state.output_length
+            return output.from_address(state.output).raw
+        finally:
+            # the buffer was allocated by the program's realloc
+            libc.free(ctypes.c_void_p(state.output))
+
+    def map(self, inputs, workers=None):
+        # the output for each of inputs, run on a pool of threads. the native
+        # code runs without the gil, so this uses as many cores as workers
+        with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            return list(pool.map(self, inputs))
+
+
+def compile(source, opt_level=2, ast_optimize=True, eof_behavior="zero",
+            cell_bits=CELL_BIT_SIZE, tape_bits=INDEX_BIT_SIZE,
+            guard_pages=False, step_budget=DEFAULT_STEP_BUDGET,
+            outline_size=OUTLINE_SIZE, instrumentation=DISABLED) -> Program:
+    # source is the program text as str or bytes, raises CompileError if it
+    # has any errors, warnings are ignored. instrumentation gets the time of
+    # every stage and the size of what it produced. big programs have their
+    # loops compiled separately, see IRManager.should_outline
+    with instrumentation.stage("lex"):
+        tokens = BFLexer().lex_fast(source)
+    instrumentation.count("tokens", len(tokens))
+    ast, issues = check_program(tokens, tape_bits, cell_bits, instrumentation)
+    errors = [issue for issue in issues if issue.type == "error"]
+    if errors:
+        raise CompileError(errors)
+
+    if ast_optimize:
+        with instrumentation.stage("optimize"):
+            ast = ASTOptimizer(ast.to_tree(), cell_bits).optimize()
+        if instrumentation.enabled:
+            instrumentation.count("optimized_nodes", count_nodes(ast))
+
+    with instrumentation.stage("codegen"):
+        modules = IRManager(
+            ast, eof_behavior=eof_behavior, cell_bits=cell_bits,
+            tape_bits=tape_bits, guard_pages=guard_pages,
+            step_budget=step_budget,
+            outline_size=outline_size).to_llvm_call_modules()
+    count_module(instrumentation, modules)
+
+    jit = JITCompiler(opt_level, verbose=False,
+                      instrumentation=instrumentation)
+    return Program(jit, jit.get_modules_function(modules, "bf_call"))
+
+
+def test():
+    hello = "++++++++[>++++[>++>+++>+++>+<<<<-]>+>+>->>+[<]<-]>>.>---.+++++++..+++.>>.<-.<.+++.------.--------.>>+.>++."
+
+    # output known at compile time comes back on every call
+    program = compile(hello)
+    assert program() == program() == b"Hello World!\n"
+
+    # every call reads its own input and starts on a clean tape
+    cat = compile(",[.,]")
+    assert cat(b"hello") == b"hello"
+    assert cat(b"") == b""
+    assert cat(bytearray(b"\x00world")) == b""
+
+    # a running sum of the input, left over cells would change the result
+    total = compile(">,[[-<+>],]<.", step_budget=0)
+    assert total(b"\x01\x02\x03") == b"\x06"
+    assert total(b"\x01\x02\x03") == b"\x06"
+
+    # the output buffer grows as the program writes
+    big = bytes(range(1, 256)) * 1024
+    assert cat(big) == big
+
+    # with the tape mapped instead of on the stack
+    assert compile(",[.,]", tape_bits=20, guard_pages=True)(b"mapped") == b"mapped"
+
+    # split into functions of a few ops each, in modules of their own
+    outlined = compile(hello, step_budget=0, outline_size=2)
+    assert outlined() == b"Hello World!\n"
+    assert compile(",[.,]", outline_size=None)(b"whole") == b"whole"
+
+    # many inputs at once, each on its own tape
+    inputs = [bytes([n]) * n for n in range(1, 200)]
+    assert total.map(inputs) == [bytes([n * n % 256]) for n in range(1, 200)]
+    assert cat.map(inputs, workers=4) == inputs
+
+    try:
+        compile("+[")
+    except CompileError as error:
+        assert [issue.value for issue in error.issues] == ["Missing loop close"]
+    else:
+        assert False, "unmatched brackets should not compile"
+
+
+if __name__ == "__main__":
+    test()
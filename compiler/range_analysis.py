@@ -0,0 +1,194 @@
+# abstract interpretation of the data pointer over the program. every piece
+# of code is summarized by the interval the pointer can be shifted by and the
+# interval of cells it can touch, both relative to the pointer before it, so a
+# loop only has to be looked at once no matter how deeply it is nested
+# https://en.wikipedia.org/wiki/Abstract_interpretation
+
+from math import inf
+
+from .cfgparser import BrainfuckParser
+from .flatprogram import FlatProgram, MOVE, OPEN, CLOSE, MULADD, SCAN, SET
+from .lexer import BFLexer
+from .optimizer import INDEX_BIT_SIZE
+from .semantic_analysis import SemanticIssue
+
+
+TAPE_SIZE = 2 ** INDEX_BIT_SIZE
+
+
+def union(first, second):
+    # the smallest interval holding both, None is the empty interval
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return (min(first[0], second[0]), max(first[1], second[1]))
+
+
+def shifted(interval, shift):
+    # every value of interval plus every value of shift
+    if interval is None:
+        return None
+    return (interval[0] + shift[0], interval[1] + shift[1])
+
+
+class PointerRangeAnalysis:
+    def __init__(self, ast, tape_size=TAPE_SIZE, start=0) -> None:
+        # either an ast or a FlatProgram, trees are flattened like in codegen
+        if not isinstance(ast, FlatProgram):
+            ast = FlatProgram.from_tree(ast)
+        self.program = ast
+        self.tape_size = tape_size
+        # the cell the pointer starts on
+        self.start = start
+        self.issues = []
+
+        # (shift, cells) of every loop by the index of its [
+        self.loops = {}
+        # where the pointer can end up, and the cells the program can touch,
+        # relative to the start of the tape
+        self.shift = (start, start)
+        self.cells = None
+
+    def analyze(self):
+        program = self.program
+        ops = program.ops
+        amounts = program.amounts
+        offsets = program.offsets
+
+        # the (shift, cells) summary of the code so far in each open loop,
+        # the bottom entry is the program itself
+        stack = [[self.shift, None]]
+
+        for index in range(len(program)):
+            op = ops[index]
+            summary = stack[-1]
+            shift = summary[0]
+
+            if op == MOVE:
+                amount = amounts[index]
+                summary[0] = (shift[0] + amount, shift[1] + amount)
+                continue
+
+            if op == OPEN:
+                # the loop tests the cell at its start and after every pass
+                summary[1] = union(summary[1], shift)
+                stack.append([(0, 0), (0, 0)])
+                continue
+
+            if op == CLOSE:
+                body_shift, body_cells = stack.pop()
+                body_cells = union(body_cells, body_shift)
+                loop = self.summarize_loop(body_shift, body_cells)
+                self.loops[program.jumps[index]] = loop
+
+                summary = stack[-1]
+                shift = summary[0]
+                summary[0] = shifted(shift, loop[0])
+                cells = shifted(loop[1], shift)
+            elif op == SCAN:
+                # the pointer can run any number of strides in one direction
+                if amounts[index] > 0:
+                    scan = (0, inf)
+                else:
+                    scan = (-inf, 0)
+                summary[0] = shifted(shift, scan)
+                cells = summary[0]
+            elif op == MULADD:
+                cells = union(shift, shifted(shift, (offsets[index],) * 2))
+            elif op == SET:
+                cells = shifted(shift, (offsets[index],) * 2)
+            else:
+                cells = shift
+
+            summary[1] = union(summary[1], cells)
+
+            # top level code always runs once it is reached, so touching a cell
+            # off the tape there is certain
+            if len(stack) == 1 and not self.issues:
+                self.check_bounds(index, cells)
+
+        self.shift, self.cells = stack[0]
+
+    def summarize_loop(self, body_shift, body_cells):
+        # a balanced loop leaves the pointer where it found it, any other loop
+        # can run any number of times so its shift grows without bound in the
+        # direction the body can move
+        if body_shift == (0, 0):
+            return body_shift, body_cells
+
+        low = 0 if body_shift[0] >= 0 else -inf
+        high = 0 if body_shift[1] <= 0 else inf
+        cells = (body_cells[0] if low == 0 else -inf,
+                 body_cells[1] if high == 0 else inf)
+        return (low, high), cells
+
+    def check_bounds(self, index, cells):
+        if cells[1] < 0:
+            value = "Cell before the start of the tape is used"
+        elif cells[0] >= self.tape_size:
+            value = "Cell past the end of the tape is used"
+        else:
+            return
+        self.issues.append(
+            SemanticIssue("error", value, self.program.node(index)))
+
+    def is_balanced(self, start):
+        # whether the loop starting at start always ends where it began
+        return self.loops[start][0] == (0, 0)
+
+    def in_bounds(self):
+        # whether every cell the program can touch is provably on the tape
+        cells = self.cells or (0, 0)
+        return cells[0] >= 0 and cells[1] < self.tape_size
+
+
+def test():
+    def analyze(code):
+        tokens = BFLexer().lex_fast(code)
+        analysis = PointerRangeAnalysis(FlatProgram.from_tokens(tokens))
+        analysis.analyze()
+        return analysis
+
+    # balanced loops keep the program bounded
+    analysis = analyze("++[>+++[>++<-]<-]>>.")
+    assert analysis.in_bounds()
+    assert analysis.cells == (0, 2) and analysis.shift == (2, 2)
+    assert all(analysis.is_balanced(start) for start in analysis.loops)
+
+    # an unbalanced loop or a scan can run off in its direction
+    analysis = analyze("+[>+]>.")
+    assert not analysis.in_bounds()
+    assert analysis.cells == (0, inf)
+    assert not analysis.is_balanced(1)
+
+    analysis = analyze(">>+[<]+")
+    assert analysis.cells == (-inf, 2)
+
+    # a loop that moves both ways can end up anywhere
+    analysis = analyze("+[>[<<]+]")
+    assert analysis.shift == (-inf, inf)
+
+    # moving off the start of the tape is only an error when a cell is used
+    assert not analyze("<>+").issues
+    analysis = analyze("+<<-")
+    assert [(i.type, i.node.char_index) for i in analysis.issues] == [
+        ("error", 3)]
+
+    # code inside loops might never run
+    assert not analyze("[<<-]").issues
+
+    # the tree from the parser gives the same answer
+    tree = BrainfuckParser(BFLexer().lex("+[->>+<<]>>.")).parse_program()
+    analysis = PointerRangeAnalysis(tree)
+    analysis.analyze()
+    assert analysis.cells == (0, 2)
+
+    # and the intervals follow the pointer's starting cell
+    analysis = PointerRangeAnalysis(tree, start=5)
+    analysis.analyze()
+    assert analysis.cells == (5, 7) and analysis.shift == (7, 7)
+
+
+if __name__ == "__main__":
+    test()
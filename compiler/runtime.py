@@ -0,0 +1,332 @@
+# the io runtime that gets emitted into every module, so the generated code
+# doesn't go through a libc call per byte
+# https://man7.org/linux/man-pages/man2/write.2.html
+
+from llvmlite import ir
+
+
+IO_BUFFER_SIZE = 2 ** 16
+
+byte = ir.IntType(8)
+int32 = ir.IntType(32)
+size_t = ir.IntType(64)
+void = ir.VoidType()
+
+STDIN = int32(0)
+STDOUT = int32(1)
+
+# the input and output of one run on in-memory buffers, the output buffer is
+# grown with realloc and belongs to the caller afterwards:
+# {i8* input, i64 input_length, i64 input_position,
+#  i8* output, i64 output_length, i64 output_capacity}
+io_state_type = ir.LiteralStructType(
+    (byte.as_pointer(), size_t, size_t, byte.as_pointer(), size_t, size_t))
+IN_DATA, IN_LENGTH, IN_POSITION, OUT_DATA, OUT_LENGTH, OUT_CAPACITY = range(6)
+
+# the smallest output buffer that gets allocated
+MIN_OUTPUT_CAPACITY = 2 ** 12
+
+
+def declare_external(module: ir.Module, name, function_type):
+    # a libc function, declared once however many parts of codegen use it
+    try:
+        return module.get_global(name)
+    except KeyError:
+        return ir.Function(module, function_type, name=name)
+
+
+class IORuntime:
+    def __init__(self, module: ir.Module, buffered=True, memory=False,
+                 buffers="internal") -> None:
+        # with memory, input and output go through an io state the caller
+        # passes to the entry point instead of stdin and stdout. every runtime
+        # function then takes the state as its first argument, so runs don't
+        # share anything and can go on in parallel, see call()
+        self.module = module
+        self.buffered = buffered
+        self.memory = memory
+        # when a program is split over several modules they all have their
+        # own runtime functions, but there is one set of io buffers. the main
+        # module makes its buffers "external" and the rest have them
+        # "imported" instead of defining their own
+        self.buffers = buffers
+        # the io state of the function being generated, set by bind()
+        self.io = None
+
+        io_type = ir.FunctionType(size_t, (int32, byte.as_pointer(), size_t))
+        self.write = ir.Function(module, io_type, name="write")
+        self.read = ir.Function(module, io_type, name="read")
+
+        # bf_putc(c) writes a byte, bf_getc() reads one or returns -1 on eof,
+        # bf_flush() writes out anything still buffered, and
+        # bf_write(data, length) writes a whole block straight to stdout or
+        # the output buffer
+        context = (io_state_type.as_pointer(),) if memory else ()
+        self.putc = self.declare("bf_putc", void, context + (byte,))
+        self.getc = self.declare("bf_getc", int32, context)
+        self.flush = self.declare("bf_flush", void, context)
+        self.write_all = self.declare(
+            "bf_write", void, context + (byte.as_pointer(), size_t))
+
+        if memory:
+            self.memcpy = declare_external(module, "memcpy", ir.FunctionType(
+                byte.as_pointer(), (byte.as_pointer(), byte.as_pointer(), size_t)))
+            self.realloc = declare_external(module, "realloc", ir.FunctionType(
+                byte.as_pointer(), (byte.as_pointer(), size_t)))
+            # bf_reserve(io, n) makes room for n more bytes of output
+            self.reserve = self.declare(
+                "bf_reserve", ir.IntType(1), context + (size_t,))
+
+            self.define_memory_reserve()
+            self.define_memory_write_all()
+            self.define_memory_putc()
+            self.define_memory_getc()
+            self.define_unbuffered_flush()
+            return
+
+        self.define_write_all()
+        if buffered:
+            self.out_buffer = self.declare_global(
+                "bf_out_buffer", ir.ArrayType(byte, IO_BUFFER_SIZE))
+            self.out_length = self.declare_global("bf_out_length", size_t)
+            self.in_buffer = self.declare_global(
+                "bf_in_buffer", ir.ArrayType(byte, IO_BUFFER_SIZE))
+            self.in_position = self.declare_global("bf_in_position", size_t)
+            self.in_length = self.declare_global("bf_in_length", size_t)
+
+            self.define_buffered_flush()
+            self.define_buffered_putc()
+            self.define_buffered_getc()
+        else:
+            self.define_unbuffered_flush()
+            self.define_unbuffered_putc()
+            self.define_unbuffered_getc()
+
+    def declare(self, name, return_type, argument_types):
+        function_type = ir.FunctionType(return_type, argument_types)
+        function = ir.Function(self.module, function_type, name=name)
+        function.linkage = "internal"
+        return function
+
+    def declare_global(self, name, value_type):
+        variable = ir.GlobalVariable(self.module, value_type, name=name)
+        if self.buffers == "imported":
+            return variable
+        if self.buffers == "internal":
+            variable.linkage = "internal"
+        variable.initializer = ir.Constant(value_type, None)
+        return variable
+
+    def define_write_all(self):
+        function = self.write_all
+        builder = ir.IRBuilder(function.append_basic_block(name="entry"))
+        data, length = function.args
+        entry = builder.block
+
+        check = function.append_basic_block(name="check")
+        write = function.append_basic_block(name="write")
+        done = function.append_basic_block(name="done")
+        builder.branch(check)
+
+        # write() may only take part of the buffer, so keep going until it's
+        # all out or the write fails
+        builder.position_at_start(check)
+        written = builder.phi(size_t)
+        written.add_incoming(size_t(0), entry)
+        is_done = builder.icmp_unsigned(">=", written, length)
+        builder.cbranch(is_done, done, write)
+
+        builder.position_at_start(write)
+        start = builder.gep(data, (written,))
+        count = builder.call(
+            self.write, (STDOUT, start, builder.sub(length, written)))
+        failed = builder.icmp_signed("<=", count, size_t(0))
+        written.add_incoming(builder.add(written, count), write)
+        builder.cbranch(failed, done, check)
+
+        builder.position_at_start(done)
+        builder.ret_void()
+
+    def bind(self, io):
+        # the io state argument of the entry point being generated
+        self.io = io
+
+    def call(self, builder: ir.IRBuilder, function, *args):
+        # call a runtime function, with the io state in memory mode
+        if self.memory:
+            args = (self.io,) + args
+        return builder.call(function, args)
+
+    def field(self, builder: ir.IRBuilder, io, index):
+        return builder.gep(io, (int32(0), int32(index)), inbounds=True)
+
+    def define_memory_reserve(self):
+        # the output can't fail half way through, so once the buffer can't
+        # grow the length keeps counting past the capacity and nothing else is
+        # written, the caller treats that as out of memory
+        function = self.reserve
+        builder = ir.IRBuilder(function.append_basic_block(name="entry"))
+        io, count = function.args
+
+        length = builder.load(self.field(builder, io, OUT_LENGTH))
+        capacity = builder.load(self.field(builder, io, OUT_CAPACITY))
+        needed = builder.add(length, count)
+        fits = builder.icmp_unsigned("<=", needed, capacity)
+        with builder.if_then(fits, likely=True):
+            builder.ret(ir.IntType(1)(1))
+        failed = builder.icmp_unsigned(">", length, capacity)
+        with builder.if_then(failed):
+            builder.ret(ir.IntType(1)(0))
+
+        # at least double the buffer, so output is copied O(1) times a byte
+        doubled = builder.mul(capacity, size_t(2))
+        new_capacity = builder.select(
+            builder.icmp_unsigned(">", doubled, needed), doubled, needed)
+        new_capacity = builder.select(
+            builder.icmp_unsigned(">", new_capacity, size_t(MIN_OUTPUT_CAPACITY)),
+            new_capacity, size_t(MIN_OUTPUT_CAPACITY))
+
+        data = builder.load(self.field(builder, io, OUT_DATA))
+        grown = builder.call(self.realloc, (data, new_capacity))
+        is_null = builder.icmp_unsigned(
+            "==", grown, ir.Constant(byte.as_pointer(), None))
+        with builder.if_then(is_null, likely=False):
+            builder.ret(ir.IntType(1)(0))
+
+        builder.store(grown, self.field(builder, io, OUT_DATA))
+        builder.store(new_capacity, self.field(builder, io, OUT_CAPACITY))
+        builder.ret(ir.IntType(1)(1))
+
+    def define_memory_write_all(self):
+        function = self.write_all
+        builder = ir.IRBuilder(function.append_basic_block(name="entry"))
+        io, data, count = function.args
+
+        length_field = self.field(builder, io, OUT_LENGTH)
+        has_room = builder.call(self.reserve, (io, count))
+        with builder.if_then(has_room, likely=True):
+            output = builder.load(self.field(builder, io, OUT_DATA))
+            start = builder.gep(output, (builder.load(length_field),))
+            builder.call(self.memcpy, (start, data, count))
+        builder.store(builder.add(builder.load(length_field), count), length_field)
+        builder.ret_void()
+
+    def define_memory_putc(self):
+        function = self.putc
+        builder = ir.IRBuilder(function.append_basic_block(name="entry"))
+        io, char = function.args
+
+        length_field = self.field(builder, io, OUT_LENGTH)
+        has_room = builder.call(self.reserve, (io, size_t(1)))
+        length = builder.load(length_field)
+        with builder.if_then(has_room, likely=True):
+            output = builder.load(self.field(builder, io, OUT_DATA))
+            builder.store(char, builder.gep(output, (length,)))
+        builder.store(builder.add(length, size_t(1)), length_field)
+        builder.ret_void()
+
+    def define_buffered_flush(self):
+        builder = ir.IRBuilder(self.flush.append_basic_block(name="entry"))
+        length = builder.load(self.out_length)
+        start = builder.gep(self.out_buffer, (int32(0), int32(0)))
+        builder.call(self.write_all, (start, length))
+        builder.store(size_t(0), self.out_length)
+        builder.ret_void()
+
+    def define_buffered_putc(self):
+        builder = ir.IRBuilder(self.putc.append_basic_block(name="entry"))
+        length = builder.load(self.out_length)
+        location = builder.gep(self.out_buffer, (int32(0), length))
+        builder.store(self.putc.args[0], location)
+
+        length = builder.add(length, size_t(1))
+        builder.store(length, self.out_length)
+
+        # flush once the buffer is full
+        is_full = builder.icmp_unsigned("==", length, size_t(IO_BUFFER_SIZE))
+        with builder.if_then(is_full):
+            builder.call(self.flush, ())
+        builder.ret_void()
+
+    def define_buffered_getc(self):
+        builder = ir.IRBuilder(self.getc.append_basic_block(name="entry"))
+        # the program might be waiting on a prompt it printed
+        builder.call(self.flush, ())
+
+        position = builder.load(self.in_position)
+        length = builder.load(self.in_length)
+        entry = builder.block
+
+        refill = self.getc.append_basic_block(name="refill")
+        refilled = self.getc.append_basic_block(name="refilled")
+        read = self.getc.append_basic_block(name="read")
+        end_of_file = self.getc.append_basic_block(name="eof")
+
+        is_empty = builder.icmp_unsigned(">=", position, length)
+        builder.cbranch(is_empty, refill, read)
+
+        # read ahead as much input as is available
+        builder.position_at_start(refill)
+        start = builder.gep(self.in_buffer, (int32(0), int32(0)))
+        count = builder.call(
+            self.read, (STDIN, start, size_t(IO_BUFFER_SIZE)))
+        failed = builder.icmp_signed("<=", count, size_t(0))
+        builder.cbranch(failed, end_of_file, refilled)
+
+        builder.position_at_start(refilled)
+        builder.store(count, self.in_length)
+        builder.branch(read)
+
+        builder.position_at_start(read)
+        read_position = builder.phi(size_t)
+        read_position.add_incoming(position, entry)
+        read_position.add_incoming(size_t(0), refilled)
+        char = builder.load(builder.gep(
+            self.in_buffer, (int32(0), read_position)))
+        builder.store(builder.add(read_position, size_t(1)), self.in_position)
+        builder.ret(builder.zext(char, int32))
+
+        builder.position_at_start(end_of_file)
+        builder.ret(int32(-1))
+
+    def define_memory_getc(self):
+        # the whole input is there from the start, so there's nothing to
+        # flush or refill
+        function = self.getc
+        builder = ir.IRBuilder(function.append_basic_block(name="entry"))
+        io = function.args[0]
+
+        position_field = self.field(builder, io, IN_POSITION)
+        position = builder.load(position_field)
+        length = builder.load(self.field(builder, io, IN_LENGTH))
+
+        is_empty = builder.icmp_unsigned(">=", position, length)
+        with builder.if_then(is_empty, likely=False):
+            builder.ret(int32(-1))
+
+        data = builder.load(self.field(builder, io, IN_DATA))
+        char = builder.load(builder.gep(data, (position,)))
+        builder.store(builder.add(position, size_t(1)), position_field)
+        builder.ret(builder.zext(char, int32))
+
+    def define_unbuffered_flush(self):
+        # nothing is ever buffered, or it's already in the output buffer
+        builder = ir.IRBuilder(self.flush.append_basic_block(name="entry"))
+        builder.ret_void()
+
+    def define_unbuffered_putc(self):
+        builder = ir.IRBuilder(self.putc.append_basic_block(name="entry"))
+        char = builder.alloca(byte)
+        builder.store(self.putc.args[0], char)
+        builder.call(self.write, (STDOUT, char, size_t(1)))
+        builder.ret_void()
+
+    def define_unbuffered_getc(self):
+        builder = ir.IRBuilder(self.getc.append_basic_block(name="entry"))
+        char = builder.alloca(byte)
+        count = builder.call(self.read, (STDIN, char, size_t(1)))
+
+        failed = builder.icmp_signed("<=", count, size_t(0))
+        with builder.if_then(failed):
+            builder.ret(int32(-1))
+        builder.ret(builder.zext(builder.load(char), int32))
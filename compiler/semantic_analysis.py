@@ -1,6 +1,31 @@
 from .cfgparser import BrainFuckNode, BrainfuckParser
+from .flatprogram import FlatProgram, MOVE, OPEN, CLOSE
 from .lexer import BFLexer
 from typing import List, Literal
+from itertools import accumulate, compress, count
+from operator import sub
+import re
+
+
+# the analysis works on the token bytes with table lookups, the brackets are
+# checked with running depth counters instead of a dfa, so nesting depth is
+# unbounded and there is no python code per token
+
+# 1 for a bracket and 0 for everything else, to pick out bracket positions
+BRACKET_MASK = bytes(c in b"[]" for c in range(256))
+NON_BRACKETS = bytes(c for c in range(256) if c not in b"[]")
+# [ steps the depth up by one and ] down by one, shifted up by one to fit in
+# a byte, the shift is taken off again with the bracket count
+BRACKET_STEPS = bytes.maketrans(b"[]", b"\x02\x00")
+
+EMPTY_LOOP = re.compile(rb"\[\]")
+FIRST_COMMAND = re.compile(rb"[^\[\]]")
+
+# the node value of each token, as the parser names them
+NODE_VALUES = {"[": "Loop", "]": "LoopEnd"}
+# the node values of a tree straight from the parser, an optimized tree has
+# Add, MulAdd and so on, which don't map back to tokens
+RAW_VALUES = {"+", "-", ">", "<", ".", ",", "Loop", "LoopEnd", "Program"}
 
 
 class SemanticIssue:
@@ -14,293 +39,139 @@ class SemanticIssue:
         self.type = type
 
 
-class DecrementPointerIssueDFA:
-    def __init__(self):
-        self.state = 0
-        self.accept_states = [2]
-
-        self.alphabet = [">", "<", "+", "-", ".", ",", "[", "]", "#"]
-
-        # transitions to recognize a program where the first character is a <
-        self.transitions = {
-            # initial state,
-            0: {
-                ">": 1,
-                "<": 2,
-                "+": 1,
-                "-": 1,
-                ".": 1,
-                ",": 1,
-                "[": 0,
-                "]": 0,
-                "#": 0
-            },
-            # accept state
-            1: {
-                ">": 1,
-                "<": 1,
-                "+": 1,
-                "-": 1,
-                ".": 1,
-                ",": 1,
-                "[": 1,
-                "]": 1,
-                "#": 0
-            },
-            2: {
-                ">": 2,
-                "<": 2,
-                "+": 2,
-                "-": 2,
-                ".": 2,
-                ",": 2,
-                "[": 2,
-                "]": 2,
-                "#": 2
-            },
-        }
-
-    def step(self, token):
-        if token not in self.alphabet:
-            token = "#"
-
-        self.state = self.transitions[self.state][token]
-        return self.state in self.accept_states
-
-    def reset(self):
-        self.state = 0
-
-
-class EmptyLoopIssueDFA:
-    def __init__(self):
-        self.state = 0
-        self.accept_states = [2]
-
-        self.alphabet = [">", "<", "+", "-", ".", ",", "[", "]", "#"]
-
-        # transitions to recognize a program where there exists an empty loop
-        self.transitions = {
-            # initial state,
-            0: {
-                ">": 0,
-                "<": 0,
-                "+": 0,
-                "-": 0,
-                ".": 0,
-                ",": 0,
-                "[": 1,
-                "]": 1,
-                "#": 0
-            },
-
-            # loop open state
-            1: {
-                ">": 1,
-                "<": 1,
-                "+": 1,
-                "-": 1,
-                ".": 1,
-                ",": 1,
-                "[": 1,
-                "]": 2,
-                "#": 1
-            },
-
-            # accept state (loop close immediately after loop open)
-            2: {
-                ">": 2,
-                "<": 2,
-                "+": 2,
-                "-": 2,
-                ".": 2,
-                ",": 2,
-                "[": 2,
-                "]": 2,
-                "#": 2
-            },
-        }
-
-    def step(self, token):
-        if token not in self.alphabet:
-            token = "#"
-
-        self.state = self.transitions[self.state][token]
-        return self.state in self.accept_states
-
-    def reset(self):
-        self.state = 0
-
-
-class MissingBracketDFA:
-    def __init__(self):
-        self.state = 0
-        self.accept_states = [0, 8]
-
-        self.alphabet = [">", "<", "+", "-", ".", ",", "[", "]", "#"]
-
-        # transitions to recognize a program where there is a valid bracket pairs up to 8 levels of nesting
-        self.transitions = {
-            # initial state, anything goes
-            0: {
-                ">": 0,
-                "<": 0,
-                "+": 0,
-                "-": 0,
-                ".": 0,
-                ",": 0,
-                "[": 1,
-                "]": 0,
-                "#": 0
-            },
-            # accept state
-            1: {
-                ">": 1,
-                "<": 1,
-                "+": 1,
-                "-": 1,
-                ".": 1,
-                ",": 1,
-                "[": 2,
-                "]": 0,
-                "#": 1
-            },
-            2: {
-                ">": 2,
-                "<": 2,
-                "+": 2,
-                "-": 2,
-                ".": 2,
-                ",": 2,
-                "[": 3,
-                "]": 1,
-                "#": 2
-            },
-            # initial state, anything goes
-            3: {
-                ">": 3,
-                "<": 3,
-                "+": 3,
-                "-": 3,
-                ".": 3,
-                ",": 3,
-                "[": 4,
-                "]": 2,
-                "#": 3
-            },
-            # accept state
-            4: {
-                ">": 1,
-                "<": 1,
-                "+": 1,
-                "-": 1,
-                ".": 1,
-                ",": 1,
-                "[": 5,
-                "]": 3,
-                "#": 0
-            },
-            5: {
-                ">": 5,
-                "<": 5,
-                "+": 5,
-                "-": 5,
-                ".": 5,
-                ",": 5,
-                "[": 6,
-                "]": 4,
-                "#": 5
-            },
-            6: {
-                ">": 6,
-                "<": 6,
-                "+": 6,
-                "-": 6,
-                ".": 6,
-                ",": 6,
-                "[": 7,
-                "]": 5,
-                "#": 6
-            },
-            7: {
-                ">": 7,
-                "<": 7,
-                "+": 7,
-                "-": 7,
-                ".": 7,
-                ",": 7,
-                "[": 8,
-                "]": 6,
-                "#": 7
-            },
-            8: {
-                ">": 8,
-                "<": 8,
-                "+": 8,
-                "-": 8,
-                ".": 8,
-                ",": 8,
-                "[": 8,
-                "]": 8,
-                "#": 8
-            },
-
-        }
-
-    def step(self, token):
-        if token not in self.alphabet:
-            token = "#"
-
-        self.state = self.transitions[self.state][token]
-        return self.state in self.accept_states
-
-    def reset(self):
-        self.state = 0
+def unmatched_brackets(tokens: bytes):
+    # token indices of the [ without a ] and the ] without a [
+    steps = tokens.translate(None, NON_BRACKETS).translate(BRACKET_STEPS)
+
+    # depths[i] is the nesting depth just before the i-th bracket
+    depths = [0]
+    depths.extend(map(sub, accumulate(steps), count(1)))
+    lowest = min(depths)
+    final = depths[-1]
+    if lowest == 0 and final == 0:
+        return [], []
+
+    # the token index of each bracket, only needed to report them
+    offsets = list(compress(count(), tokens.translate(BRACKET_MASK)))
+
+    # a ] is unmatched when it takes the depth to a new low, the first time
+    # each level below zero is reached
+    unopened = []
+    start = 0
+    for level in range(-1, lowest - 1, -1):
+        start = depths.index(level, start) + 1
+        unopened.append(offsets[start - 2])
+
+    # a [ is unmatched when the depth never comes back down past it, after
+    # the last time each level between the low and the end is seen
+    unclosed = []
+    reverse = depths[::-1]
+    start = 0
+    for level in range(final - 1, lowest - 1, -1):
+        start = reverse.index(level, start) + 1
+        unclosed.append(offsets[len(depths) - start])
+
+    unclosed.reverse()
+    return unclosed, unopened
 
 
 class SemanticAnalysis:
     def __init__(self, ast):
-        self.ast: BrainFuckNode = ast
+        # either the tokens (bytes, str or a list of characters), an ast
+        # straight from the parser or a FlatProgram
+        self.ast = ast
         self.issues: List[SemanticIssue] = []
-        self.dec_dfa = DecrementPointerIssueDFA()
-        self.empty_dfa = EmptyLoopIssueDFA()
-        self.bracket_dfa = MissingBracketDFA()
+
+    def get_tokens(self):
+        # the token bytes, and the node of each token if we were given a tree
+        ast = self.ast
+        if isinstance(ast, (bytes, bytearray)):
+            return bytes(ast), None
+        if isinstance(ast, (str, list, tuple)):
+            return "".join(ast).encode("ascii"), None
+        if not isinstance(ast, BrainFuckNode):
+            raise TypeError(
+                "expected tokens, a tree from the parser or a FlatProgram, "
+                "not {}".format(type(ast).__name__))
+
+        # walk the tree in order, with a stack instead of recursion
+        nodes = []
+        stack = [ast]
+        while stack:
+            node = stack.pop()
+            if node.value not in RAW_VALUES:
+                raise TypeError(
+                    "{} node in the tree, only trees from the parser can be "
+                    "analyzed".format(node.value))
+            if node.value != "Program":
+                nodes.append(node)
+            stack.extend(reversed(node.children))
+
+        values = {"Loop": "[", "LoopEnd": "]"}
+        tokens = "".join(values.get(node.value, node.value) for node in nodes)
+        return tokens.encode("ascii"), nodes
+
+    def analyze_program(self, program: FlatProgram):
+        # the same checks on the ops, runs are folded so the first move is
+        # the net move of the run, and only matched brackets are ops
+        def report(type, value, node):
+            self.issues.append(SemanticIssue(type, value, node))
+
+        ops = program.ops
+        for index, op in enumerate(ops):
+            if op == OPEN or op == CLOSE:
+                continue
+            if op == MOVE and program.amounts[index] < 0:
+                report("error", "Ptr decrement in the beginning of the program",
+                       program.node(index))
+            break
+
+        for index, op in enumerate(ops):
+            if op == OPEN and program.jumps[index] == index + 1:
+                report("warning", "[] either do nothing or run forever",
+                       program.node(index))
+
+        for position in program.unclosed:
+            report("error", "Missing loop close", BrainFuckNode("Loop", position))
+        for position in program.unopened:
+            report("error", "Missing loop open", BrainFuckNode("LoopEnd", position))
+
+        self.issues.sort(key=lambda issue: issue.node.char_index)
 
     def analyze(self):
-        ast: BrainFuckNode = self.ast
-        self.found_char_other_than_dec = False
-
-        def traverse(node: BrainFuckNode):
-            if node.value == "Loop":
-                self.bracket_dfa.step('[')
-                self.empty_dfa.step('[')
-            elif node.value == "LoopEnd":
-                self.bracket_dfa.step(']')
-
-                if self.empty_dfa.step(']'):
-                    self.issues.append(
-                        SemanticIssue(
-                            "warning", "[] either do nothing or run forever", node)
-                    )
-                    self.empty_dfa.reset()
-
-            elif node.value != "Program":
-                if self.dec_dfa.step(node.value):
-                    self.issues.append(
-                        SemanticIssue(
-                            "error", "Ptr decrement in the beginning of the program", node)
-                    )
-                self.empty_dfa.step(node.value)
-
-            # traverse ast recursively
-            for child in node.children:
-                traverse(child)
-
-        traverse(ast)
-
-        if not self.bracket_dfa.state in self.bracket_dfa.accept_states:
-            self.issues.append(
-                SemanticIssue("error", "Missing loop close", ast)
-            )
+        if isinstance(self.ast, FlatProgram):
+            self.analyze_program(self.ast)
+            return
+
+        tokens, nodes = self.get_tokens()
+
+        def get_node(index):
+            if nodes is not None:
+                return nodes[index]
+            char = chr(tokens[index])
+            return BrainFuckNode(NODE_VALUES.get(char, char), index)
+
+        def report(type, value, index):
+            self.issues.append(SemanticIssue(type, value, get_node(index)))
+
+        # the first command that isn't a bracket moves off the start of the tape
+        first = FIRST_COMMAND.search(tokens)
+        if first is not None and tokens[first.start()] == ord("<"):
+            report("error", "Ptr decrement in the beginning of the program",
+                   first.start())
+
+        for empty in EMPTY_LOOP.finditer(tokens):
+            report("warning", "[] either do nothing or run forever",
+                   empty.start())
+
+        unclosed, unopened = unmatched_brackets(tokens)
+        for index in unclosed:
+            report("error", "Missing loop close", index)
+        for index in unopened:
+            report("error", "Missing loop open", index)
+
+        # in source order
+        self.issues.sort(key=lambda issue: issue.node.char_index)
 
 
 def test():
@@ -317,6 +188,63 @@ def test():
     for issue in analyzer.issues:
         print(issue.type, issue.value, "At index {}".format(issue.node.char_index))
 
+    assert [(i.value, i.node.char_index) for i in analyzer.issues] == [
+        ("Missing loop close", 0), ("[] either do nothing or run forever", 1)]
+
+    # the tokens on their own give the same issues
+    tokens = SemanticAnalysis(lexer.lex_fast("".join(code)))
+    tokens.analyze()
+    assert [(i.value, i.node.char_index) for i in tokens.issues] == [
+        (i.value, i.node.char_index) for i in analyzer.issues]
+
+    # every unmatched bracket is found, at any depth
+    for code, unclosed, unopened in [
+            (b"", [], []),
+            (b"[[]]", [], []),
+            (b"]", [], [0]),
+            (b"[", [0], []),
+            (b"][", [1], [0]),
+            (b"[]][[]", [3], [2]),
+            (b"]]+[[-]", [3], [0, 1]),
+            (b"[" * 20 + b"]" * 19, [0], []),
+            (b"[[]]][[[+]", [5, 6], [4])]:
+        assert unmatched_brackets(code) == (unclosed, unopened), code
+
+    analyzer = SemanticAnalysis(b"[[<]]]")
+    analyzer.analyze()
+    assert [(i.type, i.value, i.node.char_index) for i in analyzer.issues] == [
+        ("error", "Ptr decrement in the beginning of the program", 2),
+        ("error", "Missing loop open", 5)]
+
+    # every kind of input gives the same issues
+    expected = [(i.type, i.value, i.node.char_index) for i in analyzer.issues]
+    for ast in (b"[[<]]]", "[[<]]]", list("[[<]]]"),
+                BrainfuckParser(list("[[<]]]")).parse_program(),
+                FlatProgram.from_tokens(b"[[<]]]")):
+        analyzer = SemanticAnalysis(ast)
+        analyzer.analyze()
+        assert [(i.type, i.value, i.node.char_index)
+                for i in analyzer.issues] == expected, ast
+
+    flat = SemanticAnalysis(FlatProgram.from_tokens(b"<<>+[]+[[-]"))
+    flat.analyze()
+    assert [(i.type, i.value, i.node.char_index) for i in flat.issues] == [
+        ("error", "Ptr decrement in the beginning of the program", 0),
+        ("warning", "[] either do nothing or run forever", 4),
+        ("error", "Missing loop close", 7)]
+
+    # an optimized tree or anything else isn't taken for tokens
+    from .optimizer import ASTOptimizer
+    optimized = ASTOptimizer(
+        FlatProgram.from_tokens(b"+++[>++<-]").to_tree()).optimize()
+    for ast in (optimized, 42):
+        try:
+            SemanticAnalysis(ast).analyze()
+        except TypeError:
+            pass
+        else:
+            assert False, ast
+
 
 if __name__ == "__main__":
     test()
@@ -3,8 +3,9 @@ import compiler.lexer as lexer
 import compiler.cfgparser as cfgparser
 import base64
 import compiler.semantic_analysis as semantic
+import compiler.optimizer as optimizer
 import compiler.code_generation as cg
-import compiler.compile as compile
+import compiler.jit as jit
 
 html = ""
 
@@ -56,7 +57,7 @@ class api:
         window.evaluate_js(
             "document.getElementById('semantic').style.display = 'flex';")
 
-        analysis = semantic.SemanticAnalysis(self.ast)
+        analysis = semantic.SemanticAnalysis(self.tokens)
         analysis.analyze()
 
         issues = analysis.issues
@@ -65,7 +66,7 @@ class api:
         text = ""
         for issue in issues:
             text += "[{}] {} at index {}\\n".format(
-                issue.type, issue.value, issue.node.char_index-1)
+                issue.type, issue.value, issue.node.char_index)
 
         if text == "":
             text = "No issues found!"
@@ -79,7 +80,8 @@ class api:
         window.evaluate_js(
             "document.getElementById('ir').style.display = 'flex';")
 
-        converter = cg.IRManager(self.ast)
+        ast = optimizer.ASTOptimizer(self.ast).optimize()
+        converter = cg.IRManager(ast)
         ir = converter.to_llvm_ir()
         self.ir = ir
 
@@ -95,7 +97,7 @@ class api:
         window.evaluate_js(
             "document.getElementById('output').style.display = 'flex';")
 
-        self.status = compile.JITCompiler().run(self.ir)
+        self.status = jit.JITCompiler().run(self.ir)
 
     def finish(self):
         window.destroy()